@@ -0,0 +1,115 @@
+"""
+Image decoding and preprocessing for the try-on pipeline.
+
+Kept apart from main.py because these functions run on its process pool:
+spawned workers import only this module, not the whole server (which would
+start another log listener and process pool in every worker).
+"""
+
+import os
+from io import BytesIO
+from typing import Union
+
+from PIL import Image
+import numpy as np
+import cv2
+import pybase64
+
+# Resize filter for fast_mode preprocessing (full quality uses LANCZOS, or
+# INTER_AREA for JPEGs, which are resized with OpenCV)
+FAST_MODE_RESAMPLE = Image.Resampling[os.getenv("FAST_MODE_RESAMPLE", "BILINEAR").upper()]
+# OpenCV interpolation matching each Pillow filter, for fast_mode JPEGs
+# (OpenCV has no Hamming filter; BOX averages like INTER_AREA)
+CV2_INTERPOLATION = {
+    Image.Resampling.NEAREST: cv2.INTER_NEAREST,
+    Image.Resampling.BOX: cv2.INTER_AREA,
+    Image.Resampling.BILINEAR: cv2.INTER_LINEAR,
+    Image.Resampling.HAMMING: cv2.INTER_LINEAR,
+    Image.Resampling.BICUBIC: cv2.INTER_CUBIC,
+    Image.Resampling.LANCZOS: cv2.INTER_LANCZOS4,
+}
+FAST_MODE_INTERPOLATION = CV2_INTERPOLATION[FAST_MODE_RESAMPLE]
+
+
+def decode_base64_image(base64_string: str) -> bytes:
+    """Decode a base64 string or data URI to raw image bytes."""
+    # Slice past a data URI prefix; with no prefix this is the string itself,
+    # not a copy (split() would copy the whole payload into a list)
+    payload = base64_string[base64_string.find(',') + 1:]
+    return pybase64.b64decode(payload)
+
+
+def get_target_size(max_size: tuple, fast_mode: bool) -> tuple:
+    """Bounding box to preprocess into; fast_mode uses a smaller one (512px)."""
+    if fast_mode:
+        # Reduce size for faster transfer and processing
+        return (512, 680) if max_size[0] >= max_size[1] else (512, 512)
+    return max_size
+
+
+def preprocess_jpeg(image: Image.Image, max_size: tuple = (768, 1024), fast_mode: bool = False) -> np.ndarray:
+    """
+    Preprocess a lazily opened JPEG, resizing with OpenCV's SIMD INTER_AREA
+    (fast_mode: FAST_MODE_RESAMPLE's equivalent). Same sizing as
+    preprocess_image; returns an RGB array.
+    """
+    max_size = get_target_size(max_size, fast_mode)
+    width, height = image.size
+    ratio = min(max_size[0] / width, max_size[1] / height, 1)
+    target = (max(1, round(width * ratio)), max(1, round(height * ratio)))
+    
+    # Pillow's libjpeg-turbo scaled decode outpaces cv2.imdecode, so keep it
+    # for the decode, drafting at 2x the (aspect-fitted) target
+    image.draft('RGB', (target[0] * 2, target[1] * 2))
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    pixels = np.asarray(image)
+    
+    if pixels.shape[1] != target[0] or pixels.shape[0] != target[1]:
+        interpolation = FAST_MODE_INTERPOLATION if fast_mode else cv2.INTER_AREA
+        pixels = cv2.resize(pixels, target, interpolation=interpolation)
+    return pixels
+
+
+def preprocess_image(image: Image.Image, max_size: tuple = (768, 1024), fast_mode: bool = False) -> Image.Image:
+    """
+    Preprocess image for model.
+    
+    fast_mode=True: Uses smaller image size (512px) and a cheaper resize filter
+    fast_mode=False: Uses full size (768px) and LANCZOS for best quality
+    """
+    max_size = get_target_size(max_size, fast_mode)
+    resample = FAST_MODE_RESAMPLE if fast_mode else Image.Resampling.LANCZOS
+    
+    # Callers pass lazily opened images, so draft() can make libjpeg decode a
+    # large JPEG at 1/2, 1/4 or 1/8 scale instead of at full resolution.
+    # Keep the draft at 2x the target so the final resize still has detail.
+    image.draft('RGB', (max_size[0] * 2, max_size[1] * 2))
+    image.thumbnail(max_size, resample)
+    if image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGB')
+    return image
+
+
+def prepare_image(data: Union[str, bytes], max_size: tuple, fast_mode: bool) -> tuple[str, tuple, bytes]:
+    """
+    Decode (base64 string or raw bytes) and preprocess an image.
+    Runs on the process pool, so it returns (mode, size, raw pixels), which
+    pickle far more cheaply than a PIL Image; rebuild with image_from_pixels.
+    """
+    if isinstance(data, str):
+        data = decode_base64_image(data)
+    
+    image = Image.open(BytesIO(data))
+    if image.format == "JPEG":
+        pixels = preprocess_jpeg(image, max_size, fast_mode=fast_mode)
+        return "RGB", (pixels.shape[1], pixels.shape[0]), pixels.tobytes()
+    
+    image = preprocess_image(image, max_size, fast_mode=fast_mode)
+    return image.mode, image.size, image.tobytes()
+
+
+def image_from_pixels(pixels: tuple[str, tuple, bytes]) -> Image.Image:
+    """Rebuild a PIL Image from prepare_image's output."""
+    mode, size, data = pixels
+    return Image.frombytes(mode, size, data)
@@ -10,24 +10,58 @@ Features:
 
 import os
 import time
-import base64
+import atexit
+import importlib.util
+import itertools
+import logging
+import queue
 import uuid
-import hashlib
+import tempfile
+import asyncio
+import multiprocessing
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import ExitStack, asynccontextmanager
+from functools import partial
 from io import BytesIO
-from typing import Optional
-from urllib.parse import urlparse
+from logging.handlers import QueueHandler, QueueListener
+from typing import AsyncIterator, Awaitable, Callable, NamedTuple, Optional, Union
+from urllib.parse import ParseResult, urlparse
 
-from fastapi import FastAPI, HTTPException, Query, Response
+from fastapi import FastAPI, HTTPException, Query, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from pydantic import BaseModel, Field
 from PIL import Image
 import httpx
+import numpy as np
+import orjson
+import cv2
+import pybase64
+import xxhash
 
 from dotenv import load_dotenv
 
+from app.imaging import decode_base64_image, image_from_pixels, prepare_image
+
 load_dotenv()
 
+# Log records are queued and written by a listener thread, so request
+# handlers never block the event loop on stdout
+log_queue = queue.SimpleQueue()
+log_handler = logging.StreamHandler()
+log_handler.setFormatter(logging.Formatter("[TryOn] %(message)s"))
+log_listener = QueueListener(log_queue, log_handler)
+log_listener.start()
+atexit.register(log_listener.stop)
+
+logger = logging.getLogger("tryon")
+logger.setLevel(os.getenv("LOG_LEVEL", "INFO").upper())
+logger.addHandler(QueueHandler(log_queue))
+logger.propagate = False
+
 # Check for API tokens
 REPLICATE_API_TOKEN = os.getenv("REPLICATE_API_TOKEN")
 HUGGINGFACE_API_TOKEN = os.getenv("HUGGINGFACE_API_TOKEN") or os.getenv("HF_TOKEN")
@@ -37,15 +71,52 @@ USE_REPLICATE = bool(REPLICATE_API_TOKEN)
 USE_HUGGINGFACE = True  # Kolors is free and doesn't require a token
 USE_FAL = bool(FAL_API_KEY)
 
+# Fal.ai request headers, built once rather than per try-on call
+FAL_HEADERS = {
+    "Authorization": f"Key {FAL_API_KEY}",
+    "Content-Type": "application/json"
+} if USE_FAL else None
+
 if USE_REPLICATE:
     import replicate
 
-print(f"[TryOn] AI backends: Replicate={USE_REPLICATE}, Fal={USE_FAL}, HuggingFace(Kolors)={USE_HUGGINGFACE}")
+# Optional Redis for caching generated try-on results across restarts/instances
+REDIS_URL = os.getenv("REDIS_URL")
+if REDIS_URL:
+    import redis.asyncio as aioredis
+
+logger.info("AI backends: Replicate=%s, Fal=%s, HuggingFace(Kolors)=%s", USE_REPLICATE, USE_FAL, USE_HUGGINGFACE)
+
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Share one pooled HTTP/2 client (and Redis pool, if configured) for all
+    requests, and warm up provider connections in the background.
+    """
+    app.state.http_client = httpx.AsyncClient(
+        http2=True,
+        limits=httpx.Limits(max_keepalive_connections=32, keepalive_expiry=HTTP_KEEPALIVE_EXPIRY),
+        event_hooks={"request": [record_host_contact]},
+    )
+    app.state.redis = aioredis.from_url(REDIS_URL) if REDIS_URL else None
+    start_background_task(preload_providers())
+    try:
+        yield
+    finally:
+        await app.state.http_client.aclose()
+        if app.state.redis is not None:
+            await app.state.redis.aclose()
+
 
 app = FastAPI(
     title="Virtual Try-On API",
     description="AI-powered virtual try-on service for clothing",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan,
+    # orjson serializes the multi-MB base64 result strings far faster than json
+    default_response_class=ORJSONResponse
 )
 
 # CORS configuration for Chrome extension
@@ -58,9 +129,274 @@ app.add_middleware(
     expose_headers=["*"],
 )
 
-# Simple in-memory cache for proxied images
-image_cache: dict[str, bytes] = {}
-CACHE_MAX_SIZE = 100
+
+class CachedImage(NamedTuple):
+    """Proxied image body plus the origin's validators for revalidation."""
+    content: bytes
+    content_type: str
+    etag: Optional[str]
+    last_modified: Optional[str]
+    expires_at: float  # time.monotonic() deadline, then revalidate
+
+
+# In-memory LRU cache for proxied images (most recently used at the end)
+image_cache: OrderedDict[str, CachedImage] = OrderedDict()
+image_cache_lock = asyncio.Lock()
+image_cache_bytes = 0
+CACHE_MAX_BYTES = int(os.getenv("PROXY_CACHE_MB", "256")) * 1024 * 1024
+# Upper bound on how long an entry is served before revalidating with the origin
+CACHE_TTL_SECONDS = float(os.getenv("PROXY_CACHE_TTL", "3600"))
+# Proxied images above this size are streamed through instead of buffered
+CACHE_MAX_OBJECT_BYTES = int(os.getenv("PROXY_CACHE_MAX_OBJECT_MB", "8")) * 1024 * 1024
+STREAM_CHUNK_SIZE = 64 * 1024
+# Origin Content-Types the proxy passes through as-is
+PROXY_RASTER_TYPES = frozenset({"image/jpeg", "image/png", "image/gif", "image/webp", "image/avif"})
+
+
+class CachedDataUri(NamedTuple):
+    """JPEG data URI rendered from a proxied image's bytes."""
+    source_hash: int  # xxh3 of the body it was rendered from (not the body, so evicted bodies are freed)
+    data_uri: str
+    width: int
+    height: int
+
+
+# Small LRU of rendered data URIs for /api/proxy/image/base64, bounded by
+# total data URI length as well as entry count
+data_uri_cache: OrderedDict[str, CachedDataUri] = OrderedDict()
+data_uri_cache_bytes = 0
+DATA_URI_CACHE_MAX_SIZE = 64
+DATA_URI_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+class CachedProductImage(NamedTuple):
+    """Preprocessed product image rendered from a proxied image's bytes."""
+    source_hash: int  # xxh3 of the body it was rendered from
+    image: Image.Image
+
+
+# LRU of preprocessed product images keyed by (url, max_size, fast_mode), so
+# repeated try-ons of the same SKU skip decode and resize
+product_image_cache: OrderedDict[tuple, CachedProductImage] = OrderedDict()
+PRODUCT_IMAGE_CACHE_MAX_SIZE = 64
+
+class GarmentLayer(NamedTuple):
+    """Garment resized for compositing, with its blend and shadow planes."""
+    premultiplied: np.ndarray  # RGB * alpha, float32
+    transparency: np.ndarray  # 1 - alpha, float32 (H, W, 1)
+    shadow_transparency: np.ndarray  # 1 - shadow opacity, float32 (H, W, 1)
+
+
+# LRU of composite garment layers keyed by (pixel hash, mode, size, target
+# size); each entry is a few MB of float32 planes, so keep it small
+garment_layer_cache: OrderedDict[tuple, GarmentLayer] = OrderedDict()
+garment_layer_lock = threading.Lock()
+GARMENT_LAYER_CACHE_MAX_SIZE = 16
+
+# Encoded try-on results for clients that asked for resultFormat='url', so
+# they fetch raw JPEG bytes instead of a base64 string inside the JSON
+class CachedResult(NamedTuple):
+    """Encoded try-on result kept for /api/tryon/result."""
+    content: bytes
+    media_type: str
+
+
+result_cache: OrderedDict[str, CachedResult] = OrderedDict()
+RESULT_CACHE_MAX_SIZE = 32
+
+# Save options for try-on results by format (see negotiate_result_format).
+# WebP method 2 is ~2x faster to encode than the default 4 at nearly the same size.
+RESULT_SAVE_OPTIONS = {
+    "AVIF": {"quality": 60},
+    "WEBP": {"quality": 85, "method": 2},
+    "JPEG": {"quality": 90},
+}
+# AVIF needs a Pillow build (or plugin) with an AVIF encoder
+Image.init()
+AVIF_SUPPORTED = "AVIF" in Image.SAVE
+
+# Seconds generated try-on results stay in Redis (when REDIS_URL is set)
+REDIS_RESULT_TTL = int(os.getenv("TRYON_RESULT_TTL", "86400"))
+
+# Threads for blocking provider SDK calls (replicate.run, Gradio predict).
+# Cancelling a try-on can't stop these, so they get their own pool rather
+# than piling up in the default executor that asyncio.to_thread shares.
+provider_executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix="provider")
+
+# Worker threads for CPU-bound PIL work; decode, resize and encode release
+# the GIL, so this keeps image handling off the event loop
+image_executor = ThreadPoolExecutor(max_workers=os.cpu_count(), thread_name_prefix="image")
+
+# Worker processes for decoding and preprocessing request images, so base64
+# decoding and PIL's Python-level work don't contend for this process's GIL.
+# The semaphore bounds how much work can queue up behind the pool. The
+# functions run there live in app.imaging, so spawned workers import that
+# lightweight module rather than this one.
+PROCESS_WORKERS = os.cpu_count() or 1
+
+
+def create_process_executor() -> ProcessPoolExecutor:
+    """Start the image process pool (again, after a worker died)."""
+    return ProcessPoolExecutor(
+        max_workers=PROCESS_WORKERS,
+        mp_context=multiprocessing.get_context("spawn"),
+        # One OpenCV thread per worker; the pool itself already uses every core
+        initializer=cv2.setNumThreads,
+        initargs=(1,)
+    )
+
+
+process_executor = create_process_executor()
+process_slots = asyncio.Semaphore(PROCESS_WORKERS)
+
+# JPEG settings for images handed to AI providers, which decode them again
+# immediately; user-facing output keeps the default quality of 90
+INTERMEDIATE_JPEG_OPTIONS = {"quality": 85, "subsampling": 2, "optimize": False, "progressive": False}
+
+# Temp files handed to the Gradio client live on RAM-backed tmpfs when available
+TEMP_IMAGE_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else None
+
+# Try-on providers by response method name
+PROVIDER_ENABLED = {
+    "ai-kolors": USE_HUGGINGFACE,
+    "ai-fal": USE_FAL,
+    "ai-replicate": USE_REPLICATE,
+}
+# Hosts each HTTP-based provider talks to first (Gradio manages its own connections)
+PROVIDER_WARMUP_URLS = {
+    "ai-fal": ("https://rest.alpha.fal.ai/", "https://fal.run/"),
+    "ai-replicate": ("https://api.replicate.com/",),
+}
+
+# Seconds an idle pooled connection is kept open, and when each outbound
+# host was last sent a request (time.monotonic()), so warm_connection only
+# opens connections the pool no longer holds
+HTTP_KEEPALIVE_EXPIRY = 60.0
+host_last_contacted: dict[str, float] = {}
+
+# Body analysis uses MediaPipe Pose when it's installed; idle pose models are
+# pooled here since each takes ~200 ms to load
+USE_MEDIAPIPE = importlib.util.find_spec("mediapipe") is not None
+pose_estimators: queue.SimpleQueue = queue.SimpleQueue()
+# Standing height assumed when converting pose landmarks to centimetres
+ASSUMED_HEIGHT_CM = 170
+
+# Hugging Face Spaces used by generate_tryon_huggingface, and their
+# connected Gradio clients
+KOLORS_SPACE = "Kwai-Kolors/Kolors-Virtual-Try-On"
+IDM_VTON_SPACE = "yisol/IDM-VTON"
+gradio_clients: dict[str, object] = {}
+gradio_clients_lock = threading.Lock()
+
+# Fire-and-forget tasks (e.g. connection warm-ups), referenced until done
+background_tasks: set[asyncio.Task] = set()
+
+class InflightTryOn:
+    """A shared try-on generation and the number of requests awaiting it."""
+    
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.waiters = 0
+
+
+# Try-on generations in flight, keyed by their inputs, so identical
+# concurrent requests await the same task
+inflight_tryons: dict[tuple, InflightTryOn] = {}
+
+# A running try-on provider is hedged (the next one started alongside it)
+# once it has taken this many times its rolling average latency
+HEDGE_LATENCY_FACTOR = float(os.getenv("TRYON_HEDGE_FACTOR", "1.5"))
+# Providers that bill per generation; a free provider is never hedged into one
+PAID_PROVIDERS = frozenset({"ai-fal", "ai-replicate"})
+
+# Consecutive failures that open a provider's circuit, and seconds it stays
+# open before one request is let through to probe it again
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("TRYON_BREAKER_FAILURES", "5"))
+BREAKER_COOLDOWN_SECONDS = float(os.getenv("TRYON_BREAKER_COOLDOWN", "60"))
+
+
+class CircuitBreaker:
+    """Skips a try-on provider after repeated failures until a cooldown passes."""
+    
+    def __init__(self):
+        self.failures = 0
+        self.opened_at = 0.0
+    
+    @property
+    def state(self) -> str:
+        if self.failures < BREAKER_FAILURE_THRESHOLD:
+            return "closed"
+        if time.monotonic() - self.opened_at < BREAKER_COOLDOWN_SECONDS:
+            return "open"
+        return "half-open"
+    
+    def allow_request(self) -> bool:
+        """Whether to call the provider; a half-open circuit admits one probe per cooldown."""
+        state = self.state
+        if state == "half-open":
+            self.opened_at = time.monotonic()
+        return state != "open"
+    
+    def record_success(self):
+        self.failures = 0
+    
+    def record_failure(self):
+        self.failures += 1
+        if self.failures >= BREAKER_FAILURE_THRESHOLD:
+            self.opened_at = time.monotonic()
+
+
+provider_breakers = {method: CircuitBreaker() for method in PROVIDER_ENABLED}
+
+# Providers tried per request; select_providers drops the worst-scoring rest
+MAX_PROVIDERS_PER_REQUEST = int(os.getenv("TRYON_MAX_PROVIDERS", "2"))
+# Weight of the newest call in a provider's rolling stats
+PROVIDER_STATS_DECAY = 0.2
+# Stats older than this are ignored, so a dropped provider gets retried
+PROVIDER_STATS_MAX_AGE = 600.0
+# Latency assumed (for hedging) for a provider without recent stats, in seconds
+PROVIDER_DEFAULT_LATENCY = 10.0
+# Redis hash the stats are persisted to, so restarts don't start cold
+PROVIDER_STATS_KEY = "tryon:provider-stats"
+
+
+class ProviderStats:
+    """Rolling (exponentially weighted) success rate and latency of a provider."""
+    
+    def __init__(self, success_rate: float = 1.0, latency: float = PROVIDER_DEFAULT_LATENCY, updated_at: float = 0.0):
+        self.success_rate = success_rate
+        self.latency = latency
+        self.updated_at = updated_at
+    
+    def record(self, success: bool, latency: float):
+        self.success_rate += PROVIDER_STATS_DECAY * (float(success) - self.success_rate)
+        # Failures are often fast errors, which would flatter the latency
+        if success:
+            self.latency += PROVIDER_STATS_DECAY * (latency - self.latency)
+        self.updated_at = time.time()
+    
+    @property
+    def is_stale(self) -> bool:
+        """No call recorded within PROVIDER_STATS_MAX_AGE (or ever)."""
+        return time.time() - self.updated_at > PROVIDER_STATS_MAX_AGE
+    
+    def expected_latency(self) -> float:
+        """Rolling latency, or PROVIDER_DEFAULT_LATENCY once the stats are stale."""
+        if self.is_stale:
+            return PROVIDER_DEFAULT_LATENCY
+        return self.latency
+    
+    def score(self, fast_mode: bool) -> Optional[float]:
+        """
+        Successes per second of waiting; fast mode weighs latency more heavily.
+        None when the stats are stale, since there's nothing recent to score.
+        """
+        if self.is_stale:
+            return None
+        return self.success_rate / (self.latency ** 2 if fast_mode else self.latency)
+
+
+provider_stats = {method: ProviderStats() for method in PROVIDER_ENABLED}
+
 
 
 # ============================================================================
@@ -88,6 +424,14 @@ class TryOnRequest(BaseModel):
     garment_type: str = Field("top", alias="garmentType")
     fast_mode: bool = Field(True, alias="fastMode", description="Use fast mode (smaller images, fewer steps)")
     ai_mode: str = Field("paid", alias="aiMode", description="AI mode: 'free' (Kolors) or 'paid' (Fal.ai)")
+    result_format: str = Field("base64", alias="resultFormat", description="Result as 'base64' (data URI) or 'url' (path to fetch the image)")
+
+    class Config:
+        populate_by_name = True
+
+
+class BodyAnalysisRequest(BaseModel):
+    user_photo: str = Field(..., alias="userPhoto", description="Base64 encoded full-body photo")
 
     class Config:
         populate_by_name = True
@@ -113,109 +457,466 @@ class HealthResponse(BaseModel):
     fal_configured: bool
     huggingface_configured: bool
     kolors_available: bool = True  # Kolors is always available (free)
+    provider_circuits: dict[str, str] = {}  # "closed", "open" or "half-open"
 
 
 # ============================================================================
 # Helper Functions
 # ============================================================================
 
-def decode_base64_image(base64_string: str) -> Image.Image:
-    """Decode base64 string to PIL Image."""
-    if ',' in base64_string:
-        base64_string = base64_string.split(',')[1]
+async def run_image_task(func, *args, **kwargs):
+    """Run a blocking image function on the image thread pool."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(image_executor, partial(func, *args, **kwargs))
+
+
+async def run_provider_call(func, *args, **kwargs):
+    """
+    Run a blocking provider SDK call on the provider thread pool.
+    Cancelling the await abandons the call; it still runs (and bills) to completion.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(provider_executor, partial(func, *args, **kwargs))
+
+
+async def run_process_task(func, *args):
+    """Run a picklable function on the process pool."""
+    global process_executor
     
-    image_data = base64.b64decode(base64_string)
-    return Image.open(BytesIO(image_data))
+    async with process_slots:
+        loop = asyncio.get_running_loop()
+        executor = process_executor
+        try:
+            return await loop.run_in_executor(executor, partial(func, *args))
+        except BrokenProcessPool:
+            # A worker died (OOM kill, decoder crash) and took the pool with
+            # it; fail the calls that were in it, but start a fresh pool for
+            # the ones after (unless a concurrent call already did)
+            if process_executor is executor:
+                logger.warning("Image process pool broke, restarting it")
+                process_executor = create_process_executor()
+                executor.shutdown(wait=False)
+            raise
+
+
+def encode_image_to_buffer(
+    image: Image.Image,
+    format: str = "JPEG",
+    quality: int = 90,
+    **save_options
+) -> BytesIO:
+    """Encode PIL Image into an in-memory file."""
+    if format == 'JPEG' and image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+    buffer = BytesIO()
+    image.save(buffer, format=format, quality=quality, **save_options)
+    return buffer
+
+
+def bytes_to_data_uri(content, mime_type: str = "image/jpeg") -> str:
+    """Wrap encoded image bytes (or a buffer view) in a base64 data URI."""
+    # SIMD base64 codec, returning str directly
+    return f"data:{mime_type};base64,{pybase64.b64encode_as_string(content)}"
 
 
 def encode_image_to_base64(image: Image.Image, format: str = "JPEG") -> str:
-    """Encode PIL Image to base64 string."""
-    buffer = BytesIO()
-    if image.mode == 'RGBA' and format == 'JPEG':
-        image = image.convert('RGB')
-    image.save(buffer, format=format, quality=90)
-    buffer.seek(0)
-    base64_string = base64.b64encode(buffer.getvalue()).decode()
-    return f"data:image/{format.lower()};base64,{base64_string}"
+    """Encode PIL Image to a base64 data URI."""
+    buffer = encode_image_to_buffer(image, format)
+    # Encode straight from the buffer's memory rather than a getvalue() copy
+    with buffer.getbuffer() as view:
+        return bytes_to_data_uri(view, f"image/{format.lower()}")
 
 
-def image_to_data_uri(image: Image.Image) -> str:
-    """Convert PIL Image to data URI for Replicate API."""
-    buffer = BytesIO()
-    if image.mode == 'RGBA':
-        image = image.convert('RGB')
-    image.save(buffer, format='JPEG', quality=90)
-    buffer.seek(0)
-    base64_string = base64.b64encode(buffer.getvalue()).decode()
-    return f"data:image/jpeg;base64,{base64_string}"
+async def upload_image_fal(image: Image.Image) -> str:
+    """
+    Upload image to Fal.ai storage and return its URL.
+    Falls back to a data URI if the upload fails.
+    """
+    content = (await run_image_task(encode_image_to_buffer, image, **INTERMEDIATE_JPEG_OPTIONS)).getvalue()
+    try:
+        client = app.state.http_client
+        response = await client.post(
+            "https://rest.alpha.fal.ai/storage/upload/initiate",
+            timeout=30.0,
+            headers=FAL_HEADERS,
+            json={"content_type": "image/jpeg", "file_name": f"{uuid.uuid4()}.jpg"}
+        )
+        response.raise_for_status()
+        upload = response.json()
+        
+        put_response = await client.put(
+            upload["upload_url"],
+            timeout=60.0,
+            headers={"Content-Type": "image/jpeg"},
+            content=content
+        )
+        put_response.raise_for_status()
+        return upload["file_url"]
+    except Exception as e:
+        logger.warning("Fal.ai upload failed, sending data URI: %s", e)
+        return bytes_to_data_uri(content)
 
 
-async def fetch_image_bytes(url: str) -> bytes:
-    """Fetch image from URL and return bytes."""
-    # Check cache first
-    cache_key = hashlib.md5(url.encode()).hexdigest()
-    if cache_key in image_cache:
-        return image_cache[cache_key]
+async def upload_image_replicate(image: Image.Image) -> str:
+    """
+    Upload image via the Replicate Files API and return its URL.
+    Falls back to a data URI if the upload fails.
+    """
+    content = (await run_image_task(encode_image_to_buffer, image, **INTERMEDIATE_JPEG_OPTIONS)).getvalue()
+    try:
+        response = await app.state.http_client.post(
+            "https://api.replicate.com/v1/files",
+            timeout=60.0,
+            headers={"Authorization": f"Bearer {REPLICATE_API_TOKEN}"},
+            files={"content": (f"{uuid.uuid4()}.jpg", content, "image/jpeg")}
+        )
+        response.raise_for_status()
+        return response.json()["urls"]["get"]
+    except Exception as e:
+        logger.warning("Replicate upload failed, sending data URI: %s", e)
+        return bytes_to_data_uri(content)
+
+
+def get_freshness_lifetime(headers: httpx.Headers) -> float:
+    """
+    Seconds a response may be served from cache without revalidation.
+    Uses the origin's max-age, capped at (and defaulting to) CACHE_TTL_SECONDS.
+    """
+    cache_control = headers.get("cache-control", "").lower()
+    if "no-cache" in cache_control or "no-store" in cache_control:
+        return 0.0
+    for directive in cache_control.split(","):
+        name, _, value = directive.strip().partition("=")
+        if name == "max-age" and value.isdigit():
+            return min(float(value), CACHE_TTL_SECONDS)
+    return CACHE_TTL_SECONDS
+
+
+async def store_cached_image(url: str, entry: CachedImage):
+    """Insert an entry into the LRU, evicting until it fits the byte budget."""
+    global image_cache_bytes
+    
+    # Images larger than the whole budget are not cached
+    if len(entry.content) > CACHE_MAX_BYTES:
+        return
+    
+    async with image_cache_lock:
+        previous = image_cache.pop(url, None)
+        if previous is not None:
+            image_cache_bytes -= len(previous.content)
+        image_cache[url] = entry
+        image_cache_bytes += len(entry.content)
+        while image_cache_bytes > CACHE_MAX_BYTES:
+            _, evicted = image_cache.popitem(last=False)
+            image_cache_bytes -= len(evicted.content)
+
+
+def get_image_content_type(headers: httpx.Headers, head: bytes) -> str:
+    """
+    Image MIME type from the origin's Content-Type, else from magic bytes.
+    Only raster types are trusted from the origin; anything else (notably
+    scriptable image/svg+xml) is sniffed, falling back to JPEG.
+    """
+    origin_type = headers.get("content-type", "").split(";")[0].strip().lower()
+    if origin_type in PROXY_RASTER_TYPES:
+        return origin_type
+    if head.startswith(b"\x89PNG"):
+        return "image/png"
+    if head.startswith(b"GIF8"):
+        return "image/gif"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp"
+    if head[4:12] == b"ftypavif":
+        return "image/avif"
+    return "image/jpeg"
+
+
+async def stream_image_body(
+    response: httpx.Response,
+    head: bytes,
+    chunks: AsyncIterator[bytes]
+) -> AsyncIterator[bytes]:
+    """Yield an image body too large to buffer, then release the connection."""
+    try:
+        if head:
+            yield head
+        async for chunk in chunks:
+            yield chunk
+    finally:
+        await response.aclose()
+
+
+async def fetch_image(
+    url: str,
+    stream_large: bool = False,
+    parsed: Optional[ParseResult] = None
+) -> tuple[Union[bytes, AsyncIterator[bytes]], str]:
+    """
+    Fetch image from URL, serving from and filling the LRU cache.
+    Returns the body and its content type. Callers that already parsed
+    the URL can pass it as `parsed` to avoid parsing it again.
+    
+    stream_large=True: bodies larger than CACHE_MAX_OBJECT_BYTES are not
+    buffered or cached; an async iterator over the body is returned instead.
+    stream_large=False: the full body is always returned as bytes.
+    """
+    # Check cache first (keyed by the URL itself, which is already unique)
+    async with image_cache_lock:
+        cached = image_cache.get(url)
+        if cached is not None:
+            image_cache.move_to_end(url)
+            if cached.expires_at > time.monotonic():
+                return cached.content, cached.content_type
+    
+    if parsed is None:
+        parsed = urlparse(url)
     
     headers = {
         "User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
         "Accept": "image/webp,image/apng,image/*,*/*;q=0.8",
         "Accept-Language": "en-US,en;q=0.9",
-        "Referer": urlparse(url).scheme + "://" + urlparse(url).netloc + "/",
+        "Referer": f"{parsed.scheme}://{parsed.netloc}/",
     }
     
-    async with httpx.AsyncClient(timeout=30.0, follow_redirects=True) as client:
-        response = await client.get(url, headers=headers)
-        response.raise_for_status()
+    # Stale entry: ask the origin to confirm our copy instead of resending it
+    if cached is not None:
+        if cached.etag:
+            headers["If-None-Match"] = cached.etag
+        if cached.last_modified:
+            headers["If-Modified-Since"] = cached.last_modified
+    
+    client = app.state.http_client
+    request = client.build_request("GET", url, headers=headers, timeout=30.0)
+    response = await client.send(request, stream=True, follow_redirects=True)
+    try:
+        expires_at = time.monotonic() + get_freshness_lifetime(response.headers)
+        
+        if response.status_code == 304 and cached is not None:
+            # Not modified: keep the cached body, refresh validators and expiry
+            await response.aclose()
+            await store_cached_image(url, cached._replace(
+                etag=response.headers.get("etag", cached.etag),
+                last_modified=response.headers.get("last-modified", cached.last_modified),
+                expires_at=expires_at,
+            ))
+            return cached.content, cached.content_type
         
-        # Cache the result
-        if len(image_cache) >= CACHE_MAX_SIZE:
-            # Remove oldest entry
-            oldest = next(iter(image_cache))
-            del image_cache[oldest]
-        image_cache[cache_key] = response.content
+        response.raise_for_status()
         
-        return response.content
+        if stream_large:
+            # Buffer up to the per-object limit; past it, switch to streaming
+            content_length = response.headers.get("content-length", "")
+            head = bytearray()
+            chunks = response.aiter_bytes(STREAM_CHUNK_SIZE)
+            if content_length.isdigit() and int(content_length) > CACHE_MAX_OBJECT_BYTES:
+                # Read just the first chunk so the type can still be sniffed
+                # (chunks.__anext__ rather than anext(), which needs Python 3.10)
+                try:
+                    head += await chunks.__anext__()
+                except StopAsyncIteration:
+                    pass
+                content_type = get_image_content_type(response.headers, head)
+                return stream_image_body(response, bytes(head), chunks), content_type
+            async for chunk in chunks:
+                head += chunk
+                if len(head) > CACHE_MAX_OBJECT_BYTES:
+                    content_type = get_image_content_type(response.headers, head)
+                    return stream_image_body(response, bytes(head), chunks), content_type
+            content = bytes(head)
+        else:
+            content = await response.aread()
+        await response.aclose()
+        content_type = get_image_content_type(response.headers, content)
+    except BaseException:
+        await response.aclose()
+        raise
+    
+    await store_cached_image(url, CachedImage(
+        content=content,
+        content_type=content_type,
+        etag=response.headers.get("etag"),
+        last_modified=response.headers.get("last-modified"),
+        expires_at=expires_at,
+    ))
+    
+    return content, content_type
 
 
-async def fetch_product_image(url: str) -> Image.Image:
-    """Fetch product image from URL."""
-    content = await fetch_image_bytes(url)
-    return Image.open(BytesIO(content))
+async def fetch_image_bytes(url: str) -> bytes:
+    """Fetch image from URL and return bytes."""
+    content, _ = await fetch_image(url)
+    return content
+
+
+def store_result(request_id: str, content: bytes, media_type: str):
+    """Keep an encoded try-on result for /api/tryon/result, evicting the oldest."""
+    result_cache[request_id] = CachedResult(content, media_type)
+    while len(result_cache) > RESULT_CACHE_MAX_SIZE:
+        result_cache.popitem(last=False)
+
+
+def get_result_cache_key(request: TryOnRequest, format: str) -> str:
+    """Redis key for a try-on's inputs and result format (128-bit hashes, so users' results never collide)."""
+    user_hash = xxhash.xxh3_128_hexdigest(request.user_photo)
+    garment_hash = xxhash.xxh3_128_hexdigest(request.product_image)
+    return f"tryon:{user_hash}:{garment_hash}:{request.garment_type}:{request.fast_mode}:{request.ai_mode}:{format}"
+
+
+def negotiate_result_format(accept: str) -> str:
+    """Result image format: AVIF or WebP when the client's Accept lists it, else JPEG."""
+    if "image/avif" in accept and AVIF_SUPPORTED:
+        return "AVIF"
+    if "image/webp" in accept:
+        return "WEBP"
+    return "JPEG"
 
 
-def preprocess_image(image: Image.Image, max_size: tuple = (768, 1024), fast_mode: bool = False) -> Image.Image:
+async def get_cached_result(key: str) -> Optional[bytes]:
+    """Encoded result stored under key, or None; Redis errors count as a miss."""
+    try:
+        return await app.state.redis.get(key)
+    except aioredis.RedisError as e:
+        logger.warning("Redis get failed: %s", e)
+        return None
+
+
+async def store_cached_result(key: str, content: bytes):
+    """Store an encoded result in Redis with REDIS_RESULT_TTL."""
+    try:
+        await app.state.redis.set(key, content, ex=REDIS_RESULT_TTL)
+    except aioredis.RedisError as e:
+        logger.warning("Redis set failed: %s", e)
+
+
+def estimate_body_measurements(photo: str) -> dict:
     """
-    Preprocess image for model.
-    
-    fast_mode=True: Uses smaller image size (512px) for faster processing
-    fast_mode=False: Uses full size (768px) for best quality
+    Estimate body measurements (cm) from a full-body photo with MediaPipe Pose.
+    Photos carry no absolute scale, so lengths assume ASSUMED_HEIGHT_CM.
     """
-    if fast_mode:
-        # Reduce size for faster transfer and processing
-        max_size = (512, 680) if max_size[0] >= max_size[1] else (512, 512)
+    import mediapipe as mp
     
-    image.thumbnail(max_size, Image.Resampling.LANCZOS)
-    if image.mode not in ('RGB', 'RGBA'):
+    image = Image.open(BytesIO(decode_base64_image(photo)))
+    # Pose landmarks don't need more than ~1 MP
+    image.draft('RGB', (1024, 1024))
+    image.thumbnail((1024, 1024))
+    if image.mode != 'RGB':
         image = image.convert('RGB')
+    width, height = image.size
+    
+    # Pose models take ~200 ms to load, so reuse them (one per concurrent call)
+    try:
+        pose = pose_estimators.get_nowait()
+    except queue.Empty:
+        pose = mp.solutions.pose.Pose(static_image_mode=True, model_complexity=1)
+    try:
+        results = pose.process(np.asarray(image))
+    finally:
+        pose_estimators.put(pose)
+    
+    if results.pose_landmarks is None:
+        raise ValueError("No person detected in photo")
+    landmarks = results.pose_landmarks.landmark
+    points = np.array([(point.x * width, point.y * height) for point in landmarks])
+    
+    def distance(a: int, b: int) -> float:
+        return float(np.linalg.norm(points[a] - points[b]))
+    
+    # Nose (0) to the midpoint of the heels (29, 30) spans ~90% of standing height
+    heels = (points[29] + points[30]) / 2
+    body_span = float(np.linalg.norm(heels - points[0]))
+    if body_span == 0 or min(landmarks[29].visibility, landmarks[30].visibility) < 0.5:
+        raise ValueError("Full body must be visible in photo")
+    cm_per_pixel = ASSUMED_HEIGHT_CM * 0.9 / body_span
+    
+    # Shoulders 11/12, hips 23/24, left arm 11 -> 13 -> 15. Chest and waist
+    # have no landmarks, so they are null (keeping the placeholder's shape)
+    return {
+        "shoulderWidth": round(distance(11, 12) * cm_per_pixel, 1),
+        "chestWidth": None,
+        "waistWidth": None,
+        "hipWidth": round(distance(23, 24) * cm_per_pixel, 1),
+        "armLength": round((distance(11, 13) + distance(13, 15)) * cm_per_pixel, 1),
+        "confidence": round(float(np.mean([point.visibility for point in landmarks])), 2)
+    }
+
+
+async def fetch_product_image(url: str, max_size: tuple, fast_mode: bool) -> Image.Image:
+    """
+    Fetch product image from URL, preprocessed for the model.
+    Results are memoized per (url, max_size, fast_mode) while the cached
+    bytes are unchanged; the returned image is shared, so treat it as read-only.
+    """
+    content = await fetch_image_bytes(url)
+    source_hash = xxhash.xxh3_128_intdigest(content)
+    
+    key = (url, max_size, fast_mode)
+    cached = product_image_cache.get(key)
+    if cached is not None and cached.source_hash == source_hash:
+        product_image_cache.move_to_end(key)
+        return cached.image
+    
+    image = image_from_pixels(await run_process_task(prepare_image, content, max_size, fast_mode))
+    product_image_cache[key] = CachedProductImage(source_hash, image)
+    product_image_cache.move_to_end(key)
+    while len(product_image_cache) > PRODUCT_IMAGE_CACHE_MAX_SIZE:
+        product_image_cache.popitem(last=False)
     return image
 
 
+GARMENT_DESCRIPTIONS = {
+    "top": "A fashionable top, casual wear, fitted style",
+    "shirt": "A button-up shirt, formal or casual, well-fitted",
+    "sweater": "A cozy knit sweater, comfortable fit",
+    "cardigan": "A stylish cardigan sweater, open front, elegant drape",
+    "jacket": "A tailored jacket, structured fit, outerwear",
+    "dress": "An elegant dress, flattering silhouette",
+    "pants": "Well-fitted pants, tailored cut",
+    "jeans": "Classic denim jeans, modern fit",
+    "shorts": "Casual shorts, comfortable fit",
+    "skirt": "A stylish skirt, flattering length",
+}
+
+UPPER_BODY_GARMENTS = frozenset({"top", "shirt", "sweater", "cardigan", "jacket", "dress"})
+LOWER_BODY_GARMENTS = frozenset({"pants", "jeans", "shorts", "skirt"})
+
+# Try-on model body category; anything not listed is treated as lower body
+GARMENT_CATEGORIES = {
+    garment_type: "upper_body" for garment_type in UPPER_BODY_GARMENTS
+}
+GARMENT_CATEGORIES["dress"] = "dresses"
+
+
 def get_garment_description(garment_type: str) -> str:
     """Generate detailed garment description for AI model."""
-    descriptions = {
-        "top": "A fashionable top, casual wear, fitted style",
-        "shirt": "A button-up shirt, formal or casual, well-fitted",
-        "sweater": "A cozy knit sweater, comfortable fit",
-        "cardigan": "A stylish cardigan sweater, open front, elegant drape",
-        "jacket": "A tailored jacket, structured fit, outerwear",
-        "dress": "An elegant dress, flattering silhouette",
-        "pants": "Well-fitted pants, tailored cut",
-        "jeans": "Classic denim jeans, modern fit",
-        "shorts": "Casual shorts, comfortable fit",
-        "skirt": "A stylish skirt, flattering length",
-    }
-    return descriptions.get(garment_type, f"A {garment_type} clothing item, well-fitted, stylish")
+    return GARMENT_DESCRIPTIONS.get(garment_type, f"A {garment_type} clothing item, well-fitted, stylish")
+
+
+def save_temp_jpeg(image: Image.Image, stack: ExitStack) -> str:
+    """Write image to a temp JPEG that is deleted when the stack closes."""
+    # Closed before the path is handed over, since Windows can't reopen a
+    # NamedTemporaryFile by name while it is still open
+    with tempfile.NamedTemporaryFile(suffix='.jpg', dir=TEMP_IMAGE_DIR, delete=False) as temp_file:
+        stack.callback(os.unlink, temp_file.name)
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        image.save(temp_file, format='JPEG', **INTERMEDIATE_JPEG_OPTIONS)
+    return temp_file.name
+
+
+def get_gradio_client(space: str, hf_token: Optional[str] = None):
+    """
+    Shared Gradio client for a Hugging Face Space. Connecting fetches the
+    Space's config over several round trips, so clients are reused across
+    requests (predict calls on one client can run concurrently).
+    """
+    from gradio_client import Client
+    
+    with gradio_clients_lock:
+        client = gradio_clients.get(space)
+        if client is None:
+            client = Client(space, hf_token=hf_token)
+            gradio_clients[space] = client
+        return client
 
 
 async def generate_tryon_replicate(
@@ -230,24 +931,26 @@ async def generate_tryon_replicate(
     if not USE_REPLICATE:
         raise ValueError("Replicate API token not configured")
     
-    # Convert images to data URIs
-    user_uri = image_to_data_uri(user_photo)
-    garment_uri = image_to_data_uri(garment_image)
+    # Upload images as files rather than inlining them as base64 data URIs
+    user_uri, garment_uri = await asyncio.gather(
+        upload_image_replicate(user_photo),
+        upload_image_replicate(garment_image)
+    )
     
     # Determine body category
-    is_upper = garment_type in ["top", "shirt", "sweater", "cardigan", "jacket", "dress"]
-    category = "upper_body" if is_upper else "lower_body"
-    if garment_type == "dress":
-        category = "dresses"
+    is_upper = garment_type in UPPER_BODY_GARMENTS
+    category = GARMENT_CATEGORIES.get(garment_type, "lower_body")
     
     # Detailed garment description for better results
     garment_desc = get_garment_description(garment_type)
     
-    print(f"[TryOn] Generating with Replicate - type: {garment_type}, category: {category}")
+    logger.info("Generating with Replicate - type: %s, category: %s", garment_type, category)
     
     # Try IDM-VTON model (best for virtual try-on)
     try:
-        output = replicate.run(
+        # replicate.run blocks until the prediction finishes, so run it in a thread
+        output = await run_provider_call(
+            replicate.run,
             "cuuupid/idm-vton:c871bb9b046607b680449ecbae55fd8c6d945e0a1948644bf2361b3d021d3ff4",
             input={
                 "crop": False,
@@ -263,19 +966,19 @@ async def generate_tryon_replicate(
         
         if output:
             result_url = str(output)
-            print(f"[TryOn] IDM-VTON success, fetching result from: {result_url[:50]}...")
-            async with httpx.AsyncClient(timeout=60.0) as client:
-                response = await client.get(result_url)
-                response.raise_for_status()
-                return Image.open(BytesIO(response.content))
+            logger.info("IDM-VTON success, fetching result from: %s...", result_url[:50])
+            response = await app.state.http_client.get(result_url, timeout=60.0)
+            response.raise_for_status()
+            return Image.open(BytesIO(response.content))
                 
     except Exception as e:
-        print(f"[TryOn] IDM-VTON failed: {e}")
+        logger.warning("IDM-VTON failed: %s", e)
     
     # Fallback: Try OOTDiffusion model
     try:
-        print("[TryOn] Trying OOTDiffusion model...")
-        output = replicate.run(
+        logger.info("Trying OOTDiffusion model...")
+        output = await run_provider_call(
+            replicate.run,
             "levihsu/ootdiffusion:dc2f0c870be33de6e66ae3d348564e13e42523a1dff8c3a3d91def0a5c3bf5d5",
             input={
                 "seed": 42,
@@ -291,14 +994,13 @@ async def generate_tryon_replicate(
         
         if output and len(output) > 0:
             result_url = output[0] if isinstance(output, list) else str(output)
-            print(f"[TryOn] OOTDiffusion success")
-            async with httpx.AsyncClient(timeout=60.0) as client:
-                response = await client.get(result_url)
-                response.raise_for_status()
-                return Image.open(BytesIO(response.content))
+            logger.info("OOTDiffusion success")
+            response = await app.state.http_client.get(result_url, timeout=60.0)
+            response.raise_for_status()
+            return Image.open(BytesIO(response.content))
                 
     except Exception as e:
-        print(f"[TryOn] OOTDiffusion failed: {e}")
+        logger.warning("OOTDiffusion failed: %s", e)
     
     raise ValueError("All Replicate models failed")
 
@@ -319,63 +1021,60 @@ async def generate_tryon_fal(
     if not USE_FAL:
         raise ValueError("Fal.ai API key not configured")
     
-    # Convert images to base64 data URIs
-    user_uri = image_to_data_uri(user_photo)
-    garment_uri = image_to_data_uri(garment_image)
+    # Upload images to Fal storage rather than inlining them as base64 data URIs
+    user_uri, garment_uri = await asyncio.gather(
+        upload_image_fal(user_photo),
+        upload_image_fal(garment_image)
+    )
     
     # Determine category
-    is_upper = garment_type in ["top", "shirt", "sweater", "cardigan", "jacket", "dress"]
-    category = "upper_body" if is_upper else "lower_body"
-    if garment_type == "dress":
-        category = "dresses"
+    category = GARMENT_CATEGORIES.get(garment_type, "lower_body")
     
     # Fast mode uses fewer steps for quicker results
     num_steps = 20 if fast_mode else 30
     
-    print(f"[TryOn] Using Fal.ai IDM-VTON, category: {category}, steps: {num_steps}")
+    logger.info("Using Fal.ai IDM-VTON, category: %s, steps: %s", category, num_steps)
     
     try:
-        async with httpx.AsyncClient(timeout=90.0) as client:
-            response = await client.post(
-                "https://fal.run/fal-ai/idm-vton",
-                headers={
-                    "Authorization": f"Key {FAL_API_KEY}",
-                    "Content-Type": "application/json"
-                },
-                json={
-                    "human_image_url": user_uri,
-                    "garment_image_url": garment_uri,
-                    "description": get_garment_description(garment_type),
-                    "category": category,
-                    "num_inference_steps": num_steps,
-                    "seed": 42,
-                    "guidance_scale": 2.0 if fast_mode else 2.5  # Slightly lower for speed
-                }
-            )
+        client = app.state.http_client
+        response = await client.post(
+            "https://fal.run/fal-ai/idm-vton",
+            timeout=90.0,
+            headers=FAL_HEADERS,
+            json={
+                "human_image_url": user_uri,
+                "garment_image_url": garment_uri,
+                "description": get_garment_description(garment_type),
+                "category": category,
+                "num_inference_steps": num_steps,
+                "seed": 42,
+                "guidance_scale": 2.0 if fast_mode else 2.5  # Slightly lower for speed
+            }
+        )
+        
+        if response.status_code == 200:
+            result = response.json()
+            logger.debug("Fal.ai response: %s", list(result.keys()))
             
-            if response.status_code == 200:
-                result = response.json()
-                print(f"[TryOn] Fal.ai response: {list(result.keys())}")
-                
-                # Get the result image URL
-                if "image" in result:
-                    image_url = result["image"].get("url") if isinstance(result["image"], dict) else result["image"]
-                elif "images" in result and len(result["images"]) > 0:
-                    image_url = result["images"][0].get("url") if isinstance(result["images"][0], dict) else result["images"][0]
-                else:
-                    raise ValueError(f"Unexpected Fal response format: {result}")
-                
-                # Fetch the generated image
-                img_response = await client.get(image_url)
-                img_response.raise_for_status()
-                return Image.open(BytesIO(img_response.content))
+            # Get the result image URL
+            if "image" in result:
+                image_url = result["image"].get("url") if isinstance(result["image"], dict) else result["image"]
+            elif "images" in result and len(result["images"]) > 0:
+                image_url = result["images"][0].get("url") if isinstance(result["images"][0], dict) else result["images"][0]
             else:
-                error_text = response.text[:500]
-                print(f"[TryOn] Fal.ai error {response.status_code}: {error_text}")
-                raise ValueError(f"Fal.ai returned {response.status_code}")
-                
+                raise ValueError(f"Unexpected Fal response format: {result}")
+            
+            # Fetch the generated image
+            img_response = await client.get(image_url, timeout=90.0)
+            img_response.raise_for_status()
+            return Image.open(BytesIO(img_response.content))
+        else:
+            error_text = response.text[:500]
+            logger.warning("Fal.ai error %s: %s", response.status_code, error_text)
+            raise ValueError(f"Fal.ai returned {response.status_code}")
+            
     except Exception as e:
-        print(f"[TryOn] Fal.ai error: {e}")
+        logger.warning("Fal.ai error: %s", e)
         raise
 
 
@@ -388,121 +1087,154 @@ async def generate_tryon_huggingface(
     Generate virtual try-on using Hugging Face Spaces via Gradio Client.
     Tries Kolors Virtual Try-On first (free, good quality), then IDM-VTON as fallback.
     """
-    from gradio_client import Client, handle_file
-    import tempfile
-    import asyncio
-    
-    # Save images to temp files for Gradio client
-    with tempfile.NamedTemporaryFile(suffix='.jpg', delete=False) as user_file:
-        user_photo_rgb = user_photo.convert('RGB') if user_photo.mode != 'RGB' else user_photo
-        user_photo_rgb.save(user_file, format='JPEG', quality=95)
-        user_path = user_file.name
+    from gradio_client import handle_file
     
-    with tempfile.NamedTemporaryFile(suffix='.jpg', delete=False) as garment_file:
-        garment_rgb = garment_image.convert('RGB') if garment_image.mode != 'RGB' else garment_image
-        garment_rgb.save(garment_file, format='JPEG', quality=95)
-        garment_path = garment_file.name
-    
-    try:
-        # Try Kolors Virtual Try-On first (free, no GPU quota limits)
-        print("[TryOn] Connecting to Kolors Virtual Try-On Space...")
-        
-        def run_kolors_prediction():
-            try:
-                client = Client("Kwai-Kolors/Kolors-Virtual-Try-On")
-                
-                result = client.predict(
-                    person_img=handle_file(user_path),
-                    garment_img=handle_file(garment_path),
-                    seed=42,
-                    randomize_seed=False,
-                    api_name="/tryon"
-                )
-                
-                return ("kolors", result)
-            except Exception as e:
-                print(f"[TryOn] Kolors Gradio error: {e}")
-                return None
-        
-        # Run in thread pool to not block async
-        loop = asyncio.get_event_loop()
-        result = await loop.run_in_executor(None, run_kolors_prediction)
+    # Save images to temp files for Gradio client; the ExitStack deletes
+    # them on every exit path, including exceptions
+    with ExitStack() as stack:
+        user_path, garment_path = await asyncio.gather(
+            run_image_task(save_temp_jpeg, user_photo, stack),
+            run_image_task(save_temp_jpeg, garment_image, stack)
+        )
         
-        if result and result[0] == "kolors":
-            kolors_result = result[1]
-            print(f"[TryOn] Kolors result type: {type(kolors_result)}")
+        try:
+            # Try Kolors Virtual Try-On first (free, no GPU quota limits)
+            logger.info("Connecting to Kolors Virtual Try-On Space...")
             
-            # Handle Kolors result format
-            if isinstance(kolors_result, tuple) and len(kolors_result) > 0:
-                result_item = kolors_result[0]
-                if isinstance(result_item, str) and os.path.exists(result_item):
-                    print("[TryOn] Kolors generation successful!")
-                    return Image.open(result_item)
-                elif isinstance(result_item, dict) and 'path' in result_item:
-                    print("[TryOn] Kolors generation successful!")
-                    return Image.open(result_item['path'])
-            elif isinstance(kolors_result, str) and os.path.exists(kolors_result):
-                print("[TryOn] Kolors generation successful!")
-                return Image.open(kolors_result)
-            elif isinstance(kolors_result, dict) and 'path' in kolors_result:
-                print("[TryOn] Kolors generation successful!")
-                return Image.open(kolors_result['path'])
+            def run_kolors_prediction():
+                try:
+                    client = get_gradio_client(KOLORS_SPACE)
+                    
+                    result = client.predict(
+                        person_img=handle_file(user_path),
+                        garment_img=handle_file(garment_path),
+                        seed=42,
+                        randomize_seed=False,
+                        api_name="/tryon"
+                    )
+                    
+                    return ("kolors", result)
+                except Exception as e:
+                    logger.warning("Kolors Gradio error: %s", e)
+                    # Reconnect next time in case the Space restarted
+                    gradio_clients.pop(KOLORS_SPACE, None)
+                    return None
             
-            print(f"[TryOn] Unexpected Kolors result format: {kolors_result}")
-        
-        # Fallback to IDM-VTON Space
-        print("[TryOn] Trying IDM-VTON as fallback...")
-        
-        def run_idm_vton_prediction():
-            try:
-                client = Client("yisol/IDM-VTON", hf_token=HUGGINGFACE_API_TOKEN)
+            # Run in thread pool to not block async
+            result = await run_provider_call(run_kolors_prediction)
+            
+            if result and result[0] == "kolors":
+                kolors_result = result[1]
+                logger.debug("Kolors result type: %s", type(kolors_result))
                 
-                result = client.predict(
-                    dict={"background": handle_file(user_path), "layers": [], "composite": None},
-                    garm_img=handle_file(garment_path),
-                    garment_des=get_garment_description(garment_type),
-                    is_checked=True,  # Auto-masking
-                    is_checked_crop=False,  # Don't auto crop
-                    denoise_steps=30,
-                    seed=42,
-                    api_name="/tryon"
-                )
+                # Handle Kolors result format
+                if isinstance(kolors_result, tuple) and len(kolors_result) > 0:
+                    result_item = kolors_result[0]
+                    if isinstance(result_item, str) and os.path.exists(result_item):
+                        logger.info("Kolors generation successful!")
+                        return Image.open(result_item)
+                    elif isinstance(result_item, dict) and 'path' in result_item:
+                        logger.info("Kolors generation successful!")
+                        return Image.open(result_item['path'])
+                elif isinstance(kolors_result, str) and os.path.exists(kolors_result):
+                    logger.info("Kolors generation successful!")
+                    return Image.open(kolors_result)
+                elif isinstance(kolors_result, dict) and 'path' in kolors_result:
+                    logger.info("Kolors generation successful!")
+                    return Image.open(kolors_result['path'])
                 
-                return result
-            except Exception as e:
-                print(f"[TryOn] IDM-VTON Gradio error: {e}")
-                return None
-        
-        result = await loop.run_in_executor(None, run_idm_vton_prediction)
-        
-        if result:
-            print(f"[TryOn] IDM-VTON result type: {type(result)}")
-            # Result could be a file path or tuple
-            if isinstance(result, str) and os.path.exists(result):
-                return Image.open(result)
-            elif isinstance(result, tuple) and len(result) > 0:
-                result_path = result[0]
-                if isinstance(result_path, str) and os.path.exists(result_path):
-                    return Image.open(result_path)
-            elif isinstance(result, dict) and 'path' in result:
-                return Image.open(result['path'])
+                logger.warning("Unexpected Kolors result format: %s", kolors_result)
             
-            print(f"[TryOn] Unexpected result format: {result}")
+            # Fallback to IDM-VTON Space
+            logger.info("Trying IDM-VTON as fallback...")
             
-    except Exception as e:
-        print(f"[TryOn] Gradio client error: {e}")
-    finally:
-        # Cleanup temp files
-        import os as os_module
-        try:
-            os_module.unlink(user_path)
-            os_module.unlink(garment_path)
-        except:
-            pass
+            def run_idm_vton_prediction():
+                try:
+                    client = get_gradio_client(IDM_VTON_SPACE, hf_token=HUGGINGFACE_API_TOKEN)
+                    
+                    result = client.predict(
+                        dict={"background": handle_file(user_path), "layers": [], "composite": None},
+                        garm_img=handle_file(garment_path),
+                        garment_des=get_garment_description(garment_type),
+                        is_checked=True,  # Auto-masking
+                        is_checked_crop=False,  # Don't auto crop
+                        denoise_steps=30,
+                        seed=42,
+                        api_name="/tryon"
+                    )
+                    
+                    return result
+                except Exception as e:
+                    logger.warning("IDM-VTON Gradio error: %s", e)
+                    gradio_clients.pop(IDM_VTON_SPACE, None)
+                    return None
+            
+            result = await run_provider_call(run_idm_vton_prediction)
+            
+            if result:
+                logger.debug("IDM-VTON result type: %s", type(result))
+                # Result could be a file path or tuple
+                if isinstance(result, str) and os.path.exists(result):
+                    return Image.open(result)
+                elif isinstance(result, tuple) and len(result) > 0:
+                    result_path = result[0]
+                    if isinstance(result_path, str) and os.path.exists(result_path):
+                        return Image.open(result_path)
+                elif isinstance(result, dict) and 'path' in result:
+                    return Image.open(result['path'])
+                
+                logger.warning("Unexpected result format: %s", result)
+                
+        except Exception as e:
+            logger.warning("Gradio client error: %s", e)
     
     raise ValueError("Hugging Face model failed - try Replicate for reliable results")
 
 
+def build_garment_layer(garment_image: Image.Image, size: tuple) -> GarmentLayer:
+    """Resize a garment and precompute its blend and shadow planes."""
+    # Garment needs an alpha channel for blending; resize with high quality
+    garment = garment_image.convert('RGBA').resize(size, Image.Resampling.LANCZOS)
+    
+    # Enhance the alpha to make garment more visible but still blend
+    garment_pixels = np.asarray(garment, dtype=np.float32)
+    alpha = garment_pixels[..., 3:] * (1.2 / 255)
+    np.minimum(alpha, 1.0, out=alpha)
+    
+    # Add a subtle shadow under the garment for depth: blur just the alpha
+    # plane with OpenCV's SIMD Gaussian
+    shadow_alpha = cv2.GaussianBlur(alpha[..., 0] * 0.3, (0, 0), sigmaX=8, borderType=cv2.BORDER_REPLICATE)
+    # Opacity is squared to match the previous paste-through-own-mask look
+    shadow_alpha *= shadow_alpha
+    
+    return GarmentLayer(
+        premultiplied=garment_pixels[..., :3] * alpha,
+        transparency=1.0 - alpha,
+        shadow_transparency=(1.0 - shadow_alpha)[..., None]
+    )
+
+
+def get_garment_layer(garment_image: Image.Image, size: tuple) -> GarmentLayer:
+    """
+    Garment layer for compositing at the given size, from an LRU keyed by a
+    hash of the garment's pixels, so repeat product images skip the resize,
+    alpha and shadow work. Runs on the image thread pool, hence the lock.
+    """
+    key = (xxhash.xxh3_64_intdigest(garment_image.tobytes()), garment_image.mode, garment_image.size, size)
+    with garment_layer_lock:
+        layer = garment_layer_cache.get(key)
+        if layer is not None:
+            garment_layer_cache.move_to_end(key)
+            return layer
+    
+    layer = build_garment_layer(garment_image, size)
+    with garment_layer_lock:
+        garment_layer_cache[key] = layer
+        while len(garment_layer_cache) > GARMENT_LAYER_CACHE_MAX_SIZE:
+            garment_layer_cache.popitem(last=False)
+    return layer
+
+
 def generate_composite_tryon(
     user_photo: Image.Image,
     garment_image: Image.Image,
@@ -512,16 +1244,10 @@ def generate_composite_tryon(
     Generate a sophisticated composite try-on image.
     Uses advanced blending techniques for more realistic results.
     """
-    from PIL import ImageFilter, ImageEnhance
-    
-    # Ensure RGBA mode for alpha compositing
-    result = user_photo.copy().convert('RGBA')
-    garment = garment_image.copy().convert('RGBA')
-    
-    user_width, user_height = result.size
+    user_width, user_height = user_photo.size
     
     # Calculate garment positioning based on type
-    if garment_type in ["pants", "jeans", "shorts", "skirt"]:
+    if garment_type in LOWER_BODY_GARMENTS:
         # Lower body garment
         scale_width = 0.55
         y_position_ratio = 0.42
@@ -539,7 +1265,7 @@ def generate_composite_tryon(
     
     # Calculate new garment dimensions
     new_width = int(user_width * scale_width)
-    aspect_ratio = garment.width / garment.height
+    aspect_ratio = garment_image.width / garment_image.height
     new_height = int(new_width / aspect_ratio)
     
     # Limit height
@@ -548,57 +1274,37 @@ def generate_composite_tryon(
         new_height = max_height
         new_width = int(new_height * aspect_ratio)
     
-    # Resize garment with high quality
-    garment_resized = garment.resize((new_width, new_height), Image.Resampling.LANCZOS)
+    # Garment resized, blend-ready and with its shadow (cached per garment and size)
+    layer = get_garment_layer(garment_image, (new_width, new_height))
     
     # Position garment (centered horizontally)
     x_offset = (user_width - new_width) // 2
     y_offset = int(user_height * y_position_ratio)
     
-    # Create semi-transparent garment overlay
-    # Extract alpha channel and modify for better blending
-    if garment_resized.mode == 'RGBA':
-        r, g, b, a = garment_resized.split()
-        # Enhance the alpha to make garment more visible but still blend
-        a = ImageEnhance.Brightness(a).enhance(1.2)
-        garment_resized = Image.merge('RGBA', (r, g, b, a))
+    # Work on a single RGB array of the photo from here on (convert() would
+    # copy an RGB photo once more before np.array copies it again)
+    final_pixels = np.array(user_photo if user_photo.mode == 'RGB' else user_photo.convert('RGB'))
     
-    # Apply slight blur to edges for smoother blending
-    garment_blurred = garment_resized.filter(ImageFilter.GaussianBlur(radius=1))
+    # Darken only the shadow's own rectangle (offset by 5px and clipped to the frame)
+    shadow_x, shadow_y = x_offset + 5, y_offset + 5
+    shadow_x_end = min(shadow_x + new_width, user_width)
+    shadow_y_end = min(shadow_y + new_height, user_height)
+    if shadow_x_end > shadow_x and shadow_y_end > shadow_y:
+        shadow_roi = final_pixels[shadow_y:shadow_y_end, shadow_x:shadow_x_end]
+        shadow_transparency = layer.shadow_transparency[:shadow_y_end - shadow_y, :shadow_x_end - shadow_x]
+        shaded = shadow_roi * shadow_transparency
+        shaded += 0.5
+        np.copyto(shadow_roi, shaded, casting='unsafe')
     
-    # Create the overlay layer
-    overlay = Image.new('RGBA', result.size, (0, 0, 0, 0))
-    
-    # Paste the garment onto the overlay
-    if garment_resized.mode == 'RGBA':
-        overlay.paste(garment_resized, (x_offset, y_offset), garment_resized)
-    else:
-        overlay.paste(garment_resized, (x_offset, y_offset))
-    
-    # Blend the overlay with the original image
-    # Use alpha composite for proper transparency handling
-    result = Image.alpha_composite(result, overlay)
-    
-    # Add a subtle shadow under the garment for depth
-    shadow_overlay = Image.new('RGBA', result.size, (0, 0, 0, 0))
-    shadow = garment_resized.copy()
-    if shadow.mode == 'RGBA':
-        # Create shadow from alpha channel
-        r, g, b, a = shadow.split()
-        shadow = Image.merge('RGBA', (
-            Image.new('L', shadow.size, 0),
-            Image.new('L', shadow.size, 0),
-            Image.new('L', shadow.size, 0),
-            ImageEnhance.Brightness(a).enhance(0.3)
-        ))
-        shadow = shadow.filter(ImageFilter.GaussianBlur(radius=8))
-        shadow_overlay.paste(shadow, (x_offset + 5, y_offset + 5), shadow)
-    
-    # Composite shadow behind the main result
-    final = Image.alpha_composite(
-        Image.alpha_composite(user_photo.copy().convert('RGBA'), shadow_overlay),
-        overlay
-    )
+    # Blend the garment over its own rectangle only, in place on one temporary
+    y_end = min(y_offset + new_height, user_height)
+    rows = y_end - y_offset
+    roi = final_pixels[y_offset:y_end, x_offset:x_offset + new_width]
+    blended = roi * layer.transparency[:rows]
+    blended += layer.premultiplied[:rows]
+    blended += 0.5
+    np.copyto(roi, blended, casting='unsafe')
+    final = Image.fromarray(final_pixels)
     
     # Add "Preview Mode" watermark
     from PIL import ImageDraw, ImageFont
@@ -629,7 +1335,352 @@ def generate_composite_tryon(
     )
     draw.text((badge_x + padding, badge_y + 5), badge_text, fill=(212, 173, 117, 255), font=font)
     
-    return final.convert('RGB')
+    return final
+
+
+async def preload_providers():
+    """
+    Connect to every enabled provider at startup so request #1 doesn't pay
+    for it, and restore provider stats from Redis.
+    """
+    warmups = [
+        warm_connection(url)
+        for method, enabled in PROVIDER_ENABLED.items() if enabled
+        for url in PROVIDER_WARMUP_URLS.get(method, ())
+    ]
+    if app.state.redis is not None:
+        warmups.append(load_provider_stats())
+    await asyncio.gather(*warmups)
+    if USE_HUGGINGFACE:
+        try:
+            await asyncio.to_thread(get_gradio_client, KOLORS_SPACE)
+            logger.info("Connected to Kolors Virtual Try-On Space")
+        except Exception as e:
+            logger.warning("Kolors Space preload failed: %s", e)
+
+
+async def record_host_contact(request: httpx.Request):
+    """httpx request hook: note when each host was last contacted."""
+    host_last_contacted[request.url.host] = time.monotonic()
+
+
+async def warm_connection(url: str):
+    """
+    Open a pooled connection to a provider so its TLS handshake overlaps other
+    work. Skipped while the pool still holds one (the host was contacted
+    within HTTP_KEEPALIVE_EXPIRY).
+    """
+    last_contacted = host_last_contacted.get(httpx.URL(url).host)
+    if last_contacted is not None and time.monotonic() - last_contacted < HTTP_KEEPALIVE_EXPIRY:
+        return
+    try:
+        await app.state.http_client.head(url, timeout=5.0)
+    except httpx.HTTPError:
+        pass
+
+
+def start_background_task(coro):
+    """Schedule a fire-and-forget coroutine, keeping a reference until it finishes."""
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+
+
+def select_providers(methods: list[str], fast_mode: bool) -> list[str]:
+    """
+    The MAX_PROVIDERS_PER_REQUEST best-scoring providers, kept in the given
+    preference order (which encodes cost, e.g. free before paid). Ties keep
+    that order, so without stats this is simply the first few.
+    
+    Providers without recent stats score as the worst measured one, so an
+    untried provider never outranks a healthy measured one (real latencies
+    vary too much for a fixed default). Free providers listed ahead of every
+    paid one (free mode) are always kept: a paid provider never replaces them.
+    """
+    scores = {method: provider_stats[method].score(fast_mode) for method in methods}
+    measured = [score for score in scores.values() if score is not None]
+    prior = min(measured, default=0.0)
+    
+    required = list(itertools.takewhile(lambda method: method not in PAID_PROVIDERS, methods))
+    optional = [method for method in methods if method not in required]
+    ranked = sorted(
+        optional,
+        key=lambda method: prior if scores[method] is None else scores[method],
+        reverse=True
+    )
+    selected = set(required[:MAX_PROVIDERS_PER_REQUEST])
+    selected.update(ranked[:MAX_PROVIDERS_PER_REQUEST - len(selected)])
+    return [method for method in methods if method in selected]
+
+
+def record_provider_call(method: str, success: bool, latency: float):
+    """Update a provider's rolling stats, persisting them when Redis is configured."""
+    stats = provider_stats[method]
+    stats.record(success, latency)
+    if app.state.redis is not None:
+        start_background_task(save_provider_stats(method, stats))
+
+
+async def save_provider_stats(method: str, stats: ProviderStats):
+    """Persist one provider's stats to the PROVIDER_STATS_KEY hash."""
+    try:
+        await app.state.redis.hset(PROVIDER_STATS_KEY, method, orjson.dumps(vars(stats)))
+    except aioredis.RedisError as e:
+        logger.warning("Redis set failed: %s", e)
+
+
+async def load_provider_stats():
+    """Restore provider stats saved by a previous run."""
+    try:
+        saved = await app.state.redis.hgetall(PROVIDER_STATS_KEY)
+    except aioredis.RedisError as e:
+        logger.warning("Redis get failed: %s", e)
+        return
+    for method, data in saved.items():
+        method = method.decode()
+        if method in provider_stats:
+            provider_stats[method] = ProviderStats(**orjson.loads(data))
+
+
+async def race_providers(
+    providers: list[tuple[str, Callable[[], Awaitable[Image.Image]]]],
+    progress: Optional[Callable[..., None]] = None
+) -> tuple[Optional[Image.Image], str]:
+    """
+    Run try-on providers as a hedged race instead of one after another.
+    
+    The first provider starts immediately; each following provider starts
+    once the running ones have failed, or once the latest one has taken
+    HEDGE_LATENCY_FACTOR times its usual latency. A free provider is never
+    hedged into a paid one: paid providers only start after it fails.
+    The first successful result wins. Providers whose circuit is open are
+    skipped outright. Returns (None, "composite") if all fail. progress, if
+    given, is called as progress("attempting", method=...) for each attempt.
+    
+    The losers are cancelled, but that only abandons them: blocking SDK
+    calls (Replicate, Gradio) keep running in their threads, and a provider
+    that already accepted a job may still bill for it.
+    """
+    remaining = list(providers)
+    running: dict[asyncio.Task, tuple[str, float]] = {}
+    hedge_at = 0.0  # monotonic time to start the next provider alongside the running ones
+    try:
+        while remaining or running:
+            # Don't hedge from a free provider into a paid one; wait for it to fail
+            hedge_allowed = bool(remaining) and not (
+                remaining[0][0] in PAID_PROVIDERS
+                and any(method not in PAID_PROVIDERS for method, _ in running.values())
+            )
+            if remaining and (not running or (hedge_allowed and time.monotonic() >= hedge_at)):
+                method, generate = remaining.pop(0)
+                if not provider_breakers[method].allow_request():
+                    logger.warning("Skipping %s: circuit open after repeated failures", method)
+                    continue
+                logger.info("Attempting %s...", method)
+                if progress:
+                    progress("attempting", method=method)
+                started = time.monotonic()
+                running[asyncio.create_task(generate())] = (method, started)
+                hedge_at = started + provider_stats[method].expected_latency() * HEDGE_LATENCY_FACTOR
+                continue
+            
+            timeout = max(0.0, hedge_at - time.monotonic()) if hedge_allowed else None
+            done, _ = await asyncio.wait(running, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                method, started = running.pop(task)
+                succeeded = task.exception() is None
+                record_provider_call(method, succeeded, time.monotonic() - started)
+                if succeeded:
+                    provider_breakers[method].record_success()
+                    return task.result(), method
+                provider_breakers[method].record_failure()
+                logger.warning("%s failed: %s", method, task.exception())
+    finally:
+        # Abandon the losers and wait for their coroutines to unwind
+        for task in running:
+            task.cancel()
+        await asyncio.gather(*running, return_exceptions=True)
+    
+    return None, "composite"
+
+
+async def run_tryon(
+    request: TryOnRequest,
+    progress: Optional[Callable[..., None]] = None
+) -> tuple[Image.Image, str]:
+    """
+    Prepare the images and generate a try-on; returns (image, method).
+    progress, if given, is called as progress(stage, **details) at each stage.
+    """
+    start_time = time.time()
+    fast = request.fast_mode
+    
+    # Route based on AI mode preference (providers in order of preference)
+    if request.ai_mode == "free":
+        # FREE mode: Kolors (free) first, then Fal.ai (paid)
+        methods = ["ai-kolors", "ai-fal"]
+    else:
+        # PAID mode: Fal.ai (fast), then Replicate (quality), then Kolors (free fallback)
+        methods = ["ai-fal", "ai-replicate", "ai-kolors"]
+    methods = [method for method in methods if PROVIDER_ENABLED[method]]
+    # Only try the providers most likely to answer quickly
+    methods = select_providers(methods, fast)
+    
+    # Reopen provider connections that have gone idle while the images are prepared
+    for method in methods:
+        for url in PROVIDER_WARMUP_URLS.get(method, ()):
+            start_background_task(warm_connection(url))
+    
+    async def prepare_user_photo() -> Image.Image:
+        # Decode and preprocess user photo on the process pool
+        return image_from_pixels(
+            await run_process_task(prepare_image, request.user_photo, (768, 1024), fast)
+        )
+    
+    async def prepare_garment_image() -> Image.Image:
+        # Get product image (URL or base64)
+        if request.product_image.startswith('http'):
+            return await fetch_product_image(request.product_image, (768, 768), fast)
+        return image_from_pixels(
+            await run_process_task(prepare_image, request.product_image, (768, 768), fast)
+        )
+    
+    # The two images are independent, so prepare them concurrently
+    if progress:
+        progress("preparing")
+    user_photo, garment_image = await asyncio.gather(prepare_user_photo(), prepare_garment_image())
+    
+    logger.info("Processing with ai_mode=%s, fast_mode=%s, user_img=%s, garment_img=%s", request.ai_mode, fast, user_photo.size, garment_image.size)
+    
+    # Try AI generation first, fall back to composite
+    generators = {
+        "ai-kolors": partial(
+            generate_tryon_huggingface,
+            user_photo=user_photo,
+            garment_image=garment_image,
+            garment_type=request.garment_type
+        ),
+        "ai-fal": partial(
+            generate_tryon_fal,
+            user_photo=user_photo,
+            garment_image=garment_image,
+            garment_type=request.garment_type,
+            fast_mode=fast
+        ),
+        "ai-replicate": partial(
+            generate_tryon_replicate,
+            user_photo=user_photo,
+            garment_image=garment_image,
+            garment_type=request.garment_type
+        ),
+    }
+    providers = [(method, generators[method]) for method in methods]
+    if progress:
+        progress("generating", providers=methods)
+    result_image, method = await race_providers(providers, progress=progress)
+    if result_image is not None:
+        elapsed = time.time() - start_time
+        logger.info("%s generation successful! (%.1fs)", method, elapsed)
+    
+    # Fall back to composite if no AI available
+    if result_image is None:
+        logger.info("Falling back to composite overlay...")
+        if progress:
+            progress("compositing")
+        result_image = await run_image_task(
+            generate_composite_tryon,
+            user_photo=user_photo,
+            garment_image=garment_image,
+            garment_type=request.garment_type
+        )
+    
+    return result_image, method
+
+
+def forget_inflight_tryon(key: tuple, inflight: InflightTryOn):
+    """Stop routing new requests to a finished or abandoned generation."""
+    if inflight_tryons.get(key) is inflight:
+        del inflight_tryons[key]
+
+
+async def produce_tryon_content(
+    request: TryOnRequest,
+    result_format: str,
+    cache_key: str,
+    progress: Optional[Callable[..., None]] = None
+) -> tuple[bytes, str]:
+    """
+    Encoded try-on result as (content, method): from Redis when cached,
+    otherwise generated (sharing identical in-flight generations) and encoded.
+    """
+    # Repeat try-ons of the same photo and garment are served from Redis
+    content = await get_cached_result(cache_key) if app.state.redis is not None else None
+    if content is not None:
+        logger.info("Serving cached result")
+        return content, "cache"
+    
+    # Identical concurrent requests (e.g. a double-click) share one generation
+    key = (request.user_photo, request.product_image, request.garment_type, request.fast_mode, request.ai_mode)
+    inflight = inflight_tryons.get(key)
+    if inflight is None:
+        inflight = InflightTryOn(asyncio.create_task(run_tryon(request, progress)))
+        inflight_tryons[key] = inflight
+        inflight.task.add_done_callback(lambda _: forget_inflight_tryon(key, inflight))
+    else:
+        logger.info("Joining identical in-flight request")
+        if progress:
+            progress("generating")
+    # Shielded so one request being cancelled (its client went away) doesn't
+    # cancel the others; the generation itself is cancelled with the last one
+    inflight.waiters += 1
+    try:
+        result_image, method = await asyncio.shield(inflight.task)
+    finally:
+        inflight.waiters -= 1
+        if inflight.waiters == 0 and not inflight.task.done():
+            forget_inflight_tryon(key, inflight)
+            inflight.task.cancel()
+    
+    # Encode result (on the thread pool: Pillow releases the GIL while
+    # encoding, and shipping the image to another process costs more)
+    if progress:
+        progress("encoding")
+    buffer = await run_image_task(
+        encode_image_to_buffer, result_image, result_format, **RESULT_SAVE_OPTIONS[result_format]
+    )
+    content = buffer.getvalue()
+    # Only AI results are cached; a composite means the providers failed
+    if app.state.redis is not None and method != "composite":
+        start_background_task(store_cached_result(cache_key, content))
+    return content, method
+
+
+def build_tryon_body(
+    request: TryOnRequest,
+    content: bytes,
+    result_format: str,
+    method: str,
+    processing_time: float
+) -> dict:
+    """Successful TryOnResponse body, delivering the result as requested."""
+    media_type = f"image/{result_format.lower()}"
+    request_id = str(uuid.uuid4())
+    if request.result_format == "url":
+        store_result(request_id, content, media_type)
+        result = f"/api/tryon/result/{request_id}"
+    else:
+        result = bytes_to_data_uri(content, media_type)
+    
+    # The fields are server-built, so skip pydantic validation (and
+    # FastAPI's response_model pass) over the multi-MB result string
+    response = TryOnResponse.model_construct(
+        success=True,
+        result_image=result,
+        processing_time=processing_time,
+        request_id=request_id,
+        method=method
+    )
+    return response.model_dump(by_alias=True)
 
 
 # ============================================================================
@@ -661,7 +1712,8 @@ async def health_check():
         ai_enabled=USE_REPLICATE or USE_FAL or USE_HUGGINGFACE,
         replicate_configured=bool(REPLICATE_API_TOKEN),
         fal_configured=bool(FAL_API_KEY),
-        huggingface_configured=bool(HUGGINGFACE_API_TOKEN)
+        huggingface_configured=bool(HUGGINGFACE_API_TOKEN),
+        provider_circuits={method: breaker.state for method, breaker in provider_breakers.items()}
     )
 
 
@@ -681,26 +1733,16 @@ async def proxy_image(url: str = Query(..., description="Image URL to proxy")):
         if parsed.scheme not in ('http', 'https'):
             raise HTTPException(status_code=400, detail="Invalid URL scheme")
         
-        # Fetch image
-        image_bytes = await fetch_image_bytes(url)
-        
-        # Determine content type
-        content_type = "image/jpeg"
-        if url.lower().endswith('.png'):
-            content_type = "image/png"
-        elif url.lower().endswith('.webp'):
-            content_type = "image/webp"
-        elif url.lower().endswith('.gif'):
-            content_type = "image/gif"
+        # Fetch image (large images are streamed rather than buffered)
+        image, content_type = await fetch_image(url, stream_large=True, parsed=parsed)
         
-        return Response(
-            content=image_bytes,
-            media_type=content_type,
-            headers={
-                "Cache-Control": "public, max-age=86400",
-                "Access-Control-Allow-Origin": "*",
-            }
-        )
+        headers = {
+            "Cache-Control": "public, max-age=86400",
+            "Access-Control-Allow-Origin": "*",
+        }
+        if isinstance(image, bytes):
+            return Response(content=image, media_type=content_type, headers=headers)
+        return StreamingResponse(image, media_type=content_type, headers=headers)
         
     except httpx.HTTPStatusError as e:
         raise HTTPException(status_code=e.response.status_code, detail=f"Failed to fetch image: {e}")
@@ -708,6 +1750,29 @@ async def proxy_image(url: str = Query(..., description="Image URL to proxy")):
         raise HTTPException(status_code=500, detail=f"Proxy error: {str(e)}")
 
 
+def render_data_uri(image_bytes: bytes, source_hash: int) -> CachedDataUri:
+    """Re-encode proxied image bytes as a JPEG data URI."""
+    image = Image.open(BytesIO(image_bytes))
+    # Convert to JPEG for consistent output
+    return CachedDataUri(source_hash, encode_image_to_base64(image), image.width, image.height)
+
+
+def store_data_uri(url: str, entry: CachedDataUri):
+    """Insert a rendered data URI, evicting until both cache bounds hold."""
+    global data_uri_cache_bytes
+    
+    previous = data_uri_cache.pop(url, None)
+    if previous is not None:
+        data_uri_cache_bytes -= len(previous.data_uri)
+    if len(entry.data_uri) > DATA_URI_CACHE_MAX_BYTES:
+        return
+    data_uri_cache[url] = entry
+    data_uri_cache_bytes += len(entry.data_uri)
+    while len(data_uri_cache) > DATA_URI_CACHE_MAX_SIZE or data_uri_cache_bytes > DATA_URI_CACHE_MAX_BYTES:
+        _, evicted = data_uri_cache.popitem(last=False)
+        data_uri_cache_bytes -= len(evicted.data_uri)
+
+
 @app.get("/api/proxy/image/base64")
 async def proxy_image_base64(url: str = Query(..., description="Image URL to proxy")):
     """
@@ -716,22 +1781,21 @@ async def proxy_image_base64(url: str = Query(..., description="Image URL to pro
     """
     try:
         image_bytes = await fetch_image_bytes(url)
-        image = Image.open(BytesIO(image_bytes))
-        
-        # Convert to JPEG for consistent output
-        if image.mode in ('RGBA', 'P'):
-            image = image.convert('RGB')
+        source_hash = xxhash.xxh3_128_intdigest(image_bytes)
         
-        buffer = BytesIO()
-        image.save(buffer, format='JPEG', quality=90)
-        buffer.seek(0)
-        base64_string = base64.b64encode(buffer.getvalue()).decode()
+        # Reuse the rendered data URI while the source bytes are unchanged
+        cached = data_uri_cache.get(url)
+        if cached is not None and cached.source_hash == source_hash:
+            data_uri_cache.move_to_end(url)
+        else:
+            cached = await run_image_task(render_data_uri, image_bytes, source_hash)
+            store_data_uri(url, cached)
         
         return {
             "success": True,
-            "dataUri": f"data:image/jpeg;base64,{base64_string}",
-            "width": image.width,
-            "height": image.height
+            "dataUri": cached.data_uri,
+            "width": cached.width,
+            "height": cached.height
         }
         
     except Exception as e:
@@ -746,7 +1810,7 @@ async def proxy_image_base64(url: str = Query(..., description="Image URL to pro
 # ============================================================================
 
 @app.post("/api/tryon/generate", response_model=TryOnResponse)
-async def generate_tryon(request: TryOnRequest):
+async def generate_tryon(request: TryOnRequest, http_request: Request):
     """
     Generate a virtual try-on image.
     
@@ -758,136 +1822,37 @@ async def generate_tryon(request: TryOnRequest):
       - Smaller image sizes (512px vs 768px)
       - Fewer inference steps (20 vs 30)
       - ~40-50% faster generation
+    
+    The result is WebP (or AVIF, where supported) when the Accept header
+    lists it, JPEG otherwise. AI results carry an ETag derived from the
+    inputs; sending it back as If-None-Match with the same inputs returns
+    304 without regenerating.
     """
     start_time = time.time()
-    fast = request.fast_mode
-    ai_mode = request.ai_mode  # 'free' or 'paid'
     
     try:
-        # Decode user photo
-        user_photo = decode_base64_image(request.user_photo)
-        user_photo = preprocess_image(user_photo, (768, 1024), fast_mode=fast)
-        
-        # Get product image (URL or base64)
-        if request.product_image.startswith('http'):
-            garment_image = await fetch_product_image(request.product_image)
-        else:
-            garment_image = decode_base64_image(request.product_image)
-        
-        garment_image = preprocess_image(garment_image, (768, 768), fast_mode=fast)
+        result_format = negotiate_result_format(http_request.headers.get("accept", ""))
         
-        print(f"[TryOn] Processing with ai_mode={ai_mode}, fast_mode={fast}, user_img={user_photo.size}, garment_img={garment_image.size}")
+        # The client already holds the result for these exact inputs
+        cache_key = get_result_cache_key(request, result_format)
+        etag = f'"{xxhash.xxh3_128_hexdigest(cache_key)}"'
+        if http_request.headers.get("if-none-match") == etag:
+            return Response(status_code=304, headers={"ETag": etag, "Vary": "Accept"})
         
-        # Try AI generation first, fall back to composite
-        method = "composite"
-        result_image = None
-        
-        # Route based on AI mode preference
-        if ai_mode == "free":
-            # FREE mode: Try Kolors first, then fall back to paid options
-            
-            # 1. Try Hugging Face (Kolors) - FREE
-            if USE_HUGGINGFACE and result_image is None:
-                try:
-                    print("[TryOn] 🆓 Attempting Hugging Face (Kolors) - FREE...")
-                    result_image = await generate_tryon_huggingface(
-                        user_photo=user_photo,
-                        garment_image=garment_image,
-                        garment_type=request.garment_type
-                    )
-                    method = "ai-kolors"
-                    elapsed = time.time() - start_time
-                    print(f"[TryOn] Kolors generation successful! ({elapsed:.1f}s)")
-                except Exception as e:
-                    print(f"[TryOn] Kolors failed: {e}")
-            
-            # 2. Fall back to Fal.ai if Kolors fails
-            if USE_FAL and result_image is None:
-                try:
-                    print("[TryOn] ⚡ Falling back to Fal.ai...")
-                    result_image = await generate_tryon_fal(
-                        user_photo=user_photo,
-                        garment_image=garment_image,
-                        garment_type=request.garment_type,
-                        fast_mode=fast
-                    )
-                    method = "ai-fal"
-                    elapsed = time.time() - start_time
-                    print(f"[TryOn] Fal.ai generation successful! ({elapsed:.1f}s)")
-                except Exception as e:
-                    print(f"[TryOn] Fal.ai failed: {e}")
-        
-        else:
-            # PAID mode: Try Fal.ai first (fast), then Replicate (quality), then Kolors (free fallback)
-            
-            # 1. Try Fal.ai first (fast and reliable, paid)
-            if USE_FAL and result_image is None:
-                try:
-                    print("[TryOn] ⚡ Attempting Fal.ai - FAST (~15s)...")
-                    result_image = await generate_tryon_fal(
-                        user_photo=user_photo,
-                        garment_image=garment_image,
-                        garment_type=request.garment_type,
-                        fast_mode=fast
-                    )
-                    method = "ai-fal"
-                    elapsed = time.time() - start_time
-                    print(f"[TryOn] Fal.ai generation successful! ({elapsed:.1f}s)")
-                except Exception as e:
-                    print(f"[TryOn] Fal.ai failed: {e}")
-            
-            # 2. Try Replicate as second option (best quality, paid)
-            if USE_REPLICATE and result_image is None:
-                try:
-                    print("[TryOn] 🎨 Attempting Replicate - HIGH QUALITY...")
-                    result_image = await generate_tryon_replicate(
-                        user_photo=user_photo,
-                        garment_image=garment_image,
-                        garment_type=request.garment_type
-                    )
-                    method = "ai-replicate"
-                    print("[TryOn] Replicate generation successful!")
-                except Exception as e:
-                    print(f"[TryOn] Replicate failed: {e}")
-            
-            # 3. Fall back to Kolors if paid options fail
-            if USE_HUGGINGFACE and result_image is None:
-                try:
-                    print("[TryOn] 🆓 Falling back to Kolors (free)...")
-                    result_image = await generate_tryon_huggingface(
-                        user_photo=user_photo,
-                        garment_image=garment_image,
-                        garment_type=request.garment_type
-                    )
-                    method = "ai-kolors"
-                    elapsed = time.time() - start_time
-                    print(f"[TryOn] Kolors generation successful! ({elapsed:.1f}s)")
-                except Exception as e:
-                    print(f"[TryOn] Kolors failed: {e}")
-        
-        # Fall back to composite if no AI available
-        if result_image is None:
-            print("[TryOn] Falling back to composite overlay...")
-            result_image = generate_composite_tryon(
-                user_photo=user_photo,
-                garment_image=garment_image,
-                garment_type=request.garment_type
-            )
-        
-        # Encode result
-        result_base64 = encode_image_to_base64(result_image)
+        content, method = await produce_tryon_content(request, result_format, cache_key)
         processing_time = time.time() - start_time
         
-        return TryOnResponse(
-            success=True,
-            result_image=result_base64,
-            processing_time=processing_time,
-            method=method
-        )
+        headers = {"Vary": "Accept"}
+        if method != "composite":
+            headers["ETag"] = etag
+            headers["Cache-Control"] = "private, max-age=3600"
+        
+        body = build_tryon_body(request, content, result_format, method, processing_time)
+        return ORJSONResponse(body, headers=headers)
         
     except Exception as e:
         processing_time = time.time() - start_time
-        print(f"[TryOn] Error: {e}")
+        logger.error("Error: %s", e)
         return TryOnResponse(
             success=False,
             error=str(e),
@@ -895,50 +1860,133 @@ async def generate_tryon(request: TryOnRequest):
         )
 
 
+@app.post("/api/tryon/generate/stream")
+async def generate_tryon_stream(request: TryOnRequest, http_request: Request):
+    """
+    Same as /api/tryon/generate, streamed as server-sent events so the client
+    can show progress: 'progress' events ({"stage": "preparing" | "generating"
+    | "attempting" | "compositing" | "encoding", ...}) and then one 'result'
+    event carrying the TryOnResponse JSON. EventSource can't POST, so read
+    the response body with fetch().
+    """
+    start_time = time.time()
+    result_format = negotiate_result_format(http_request.headers.get("accept", ""))
+    events: asyncio.Queue = asyncio.Queue()
+    
+    def progress(stage: str, **details):
+        events.put_nowait(("progress", {"stage": stage, **details}))
+    
+    async def produce():
+        try:
+            cache_key = get_result_cache_key(request, result_format)
+            content, method = await produce_tryon_content(request, result_format, cache_key, progress)
+            processing_time = time.time() - start_time
+            events.put_nowait(("result", build_tryon_body(request, content, result_format, method, processing_time)))
+        except Exception as e:
+            logger.error("Error: %s", e)
+            response = TryOnResponse(success=False, error=str(e), processing_time=time.time() - start_time)
+            events.put_nowait(("result", response.model_dump(by_alias=True)))
+        finally:
+            events.put_nowait(None)
+    
+    async def stream_events() -> AsyncIterator[bytes]:
+        task = asyncio.create_task(produce())
+        try:
+            while (event := await events.get()) is not None:
+                name, data = event
+                yield b"event: " + name.encode() + b"\ndata: " + orjson.dumps(data) + b"\n\n"
+        finally:
+            # The client went away (or the stream ended): release this
+            # request's claim on the generation, which produce_tryon_content
+            # cancels once no request is waiting on it
+            task.cancel()
+    
+    return StreamingResponse(
+        stream_events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "Vary": "Accept", "X-Accel-Buffering": "no"}
+    )
+
+
+@app.get("/api/tryon/result/{request_id}")
+async def get_tryon_result(request_id: str):
+    """
+    Fetch a try-on result generated with resultFormat='url'.
+    Results are kept in a small in-memory LRU, so fetch them promptly.
+    """
+    cached = result_cache.get(request_id)
+    if cached is None:
+        raise HTTPException(status_code=404, detail="Result not found or expired")
+    
+    return Response(
+        content=cached.content,
+        media_type=cached.media_type,
+        headers={"Cache-Control": "private, max-age=3600, immutable"}
+    )
+
+
+# Placeholder measurements served when MediaPipe isn't installed, serialized once
+PLACEHOLDER_MEASUREMENTS_JSON = orjson.dumps({
+    "success": True,
+    "measurements": {
+        "shoulderWidth": 45,
+        "chestWidth": 40,
+        "waistWidth": 32,
+        "hipWidth": 38,
+        "armLength": 60,
+        "confidence": 0.75
+    }
+})
+
+
 @app.post("/api/body/analyze")
-async def analyze_body(user_photo: str = ""):
+async def analyze_body(request: BodyAnalysisRequest):
     """
-    Analyze body measurements from photo.
-    Placeholder - would use MediaPipe or similar in production.
+    Analyze body measurements from photo (sent in the JSON body as userPhoto).
+    Uses MediaPipe pose estimation when installed, placeholder values otherwise.
     """
     try:
+        user_photo = request.user_photo
         if not user_photo:
-            raise ValueError("user_photo is required")
-            
-        # Placeholder measurements
-        return {
-            "success": True,
-            "measurements": {
-                "shoulderWidth": 45,
-                "chestWidth": 40,
-                "waistWidth": 32,
-                "hipWidth": 38,
-                "armLength": 60,
-                "confidence": 0.75
-            }
-        }
+            raise ValueError("userPhoto is required")
+        
+        if not USE_MEDIAPIPE:
+            return Response(content=PLACEHOLDER_MEASUREMENTS_JSON, media_type="application/json")
+        
+        # Pose estimation is CPU-bound, so keep it off the event loop
+        measurements = await run_image_task(estimate_body_measurements, user_photo)
+        return {"success": True, "measurements": measurements}
         
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
 
+# Supported e-commerce sites, serialized once at import
+SUPPORTED_SITES = (
+    {"domain": "lululemon.com", "name": "Lululemon", "status": "active"},
+    {"domain": "amazon.com", "name": "Amazon", "status": "active"},
+    {"domain": "asos.com", "name": "ASOS", "status": "active"},
+    {"domain": "zara.com", "name": "Zara", "status": "active"},
+    {"domain": "hm.com", "name": "H&M", "status": "active"},
+    {"domain": "nordstrom.com", "name": "Nordstrom", "status": "active"},
+    {"domain": "nike.com", "name": "Nike", "status": "active"},
+    {"domain": "adidas.com", "name": "Adidas", "status": "active"},
+    {"domain": "gap.com", "name": "Gap", "status": "active"},
+    {"domain": "uniqlo.com", "name": "Uniqlo", "status": "active"},
+)
+SUPPORTED_SITES_JSON = orjson.dumps({"sites": SUPPORTED_SITES})
+SUPPORTED_SITES_HEADERS = {
+    "ETag": f'"{xxhash.xxh3_64_hexdigest(SUPPORTED_SITES_JSON)}"',
+    "Cache-Control": "public, max-age=3600",
+}
+
+
 @app.get("/api/supported-sites")
-async def get_supported_sites():
+async def get_supported_sites(request: Request):
     """Get list of supported e-commerce sites."""
-    return {
-        "sites": [
-            {"domain": "lululemon.com", "name": "Lululemon", "status": "active"},
-            {"domain": "amazon.com", "name": "Amazon", "status": "active"},
-            {"domain": "asos.com", "name": "ASOS", "status": "active"},
-            {"domain": "zara.com", "name": "Zara", "status": "active"},
-            {"domain": "hm.com", "name": "H&M", "status": "active"},
-            {"domain": "nordstrom.com", "name": "Nordstrom", "status": "active"},
-            {"domain": "nike.com", "name": "Nike", "status": "active"},
-            {"domain": "adidas.com", "name": "Adidas", "status": "active"},
-            {"domain": "gap.com", "name": "Gap", "status": "active"},
-            {"domain": "uniqlo.com", "name": "Uniqlo", "status": "active"},
-        ]
-    }
+    if request.headers.get("if-none-match") == SUPPORTED_SITES_HEADERS["ETag"]:
+        return Response(status_code=304, headers=SUPPORTED_SITES_HEADERS)
+    return Response(content=SUPPORTED_SITES_JSON, media_type="application/json", headers=SUPPORTED_SITES_HEADERS)
 
 
 # ============================================================================
@@ -947,7 +1995,7 @@ async def get_supported_sites():
 
 @app.exception_handler(Exception)
 async def global_exception_handler(request, exc):
-    return JSONResponse(
+    return ORJSONResponse(
         status_code=500,
         content={
             "success": False,
@@ -0,0 +1,58 @@
+import pytest
+
+from app import main
+
+
+PAID_MODE = ["ai-fal", "ai-replicate", "ai-kolors"]
+FREE_MODE = ["ai-kolors", "ai-fal"]
+
+
+@pytest.fixture(autouse=True)
+def fresh_stats(monkeypatch):
+    monkeypatch.setattr(main, "provider_stats", {method: main.ProviderStats() for method in main.PROVIDER_ENABLED})
+
+
+def run_requests(methods, latencies, count, fast_mode=True):
+    """Select providers for `count` requests, the first selected one succeeding each time."""
+    selections = []
+    for _ in range(count):
+        selected = main.select_providers(methods, fast_mode)
+        selections.append(selected)
+        main.provider_stats[selected[0]].record(True, latencies[selected[0]])
+    return selections
+
+
+def test_without_stats_keeps_preference_order(monkeypatch):
+    monkeypatch.setattr(main, "MAX_PROVIDERS_PER_REQUEST", 2)
+    assert main.select_providers(PAID_MODE, True) == ["ai-fal", "ai-replicate"]
+    assert main.select_providers(FREE_MODE, True) == ["ai-kolors", "ai-fal"]
+
+
+def test_measured_provider_is_not_dropped_for_untried_ones(monkeypatch):
+    monkeypatch.setattr(main, "MAX_PROVIDERS_PER_REQUEST", 2)
+    selections = run_requests(PAID_MODE, {"ai-fal": 15.0}, 5)
+    assert selections == [["ai-fal", "ai-replicate"]] * 5
+
+
+def test_free_mode_never_escalates_to_paid(monkeypatch):
+    monkeypatch.setattr(main, "MAX_PROVIDERS_PER_REQUEST", 1)
+    main.provider_stats["ai-fal"].record(True, 8.0)
+    selections = run_requests(FREE_MODE, {"ai-kolors": 40.0}, 5)
+    assert selections == [["ai-kolors"]] * 5
+
+
+def test_measured_stats_reorder_providers(monkeypatch):
+    monkeypatch.setattr(main, "MAX_PROVIDERS_PER_REQUEST", 2)
+    for _ in range(5):
+        main.provider_stats["ai-fal"].record(True, 10.0)
+        main.provider_stats["ai-replicate"].record(False, 2.0)
+        main.provider_stats["ai-kolors"].record(True, 20.0)
+    assert main.select_providers(PAID_MODE, False) == ["ai-fal", "ai-kolors"]
+
+
+def test_stale_stats_count_as_untried(monkeypatch):
+    monkeypatch.setattr(main, "MAX_PROVIDERS_PER_REQUEST", 2)
+    main.provider_stats["ai-fal"].record(True, 30.0)
+    main.provider_stats["ai-replicate"].record(False, 2.0)
+    main.provider_stats["ai-replicate"].updated_at -= main.PROVIDER_STATS_MAX_AGE + 1
+    assert main.select_providers(PAID_MODE, True) == ["ai-fal", "ai-replicate"]
@@ -108,7 +108,8 @@ const api = {
   }): Promise<{ success: boolean; resultImage?: string; error?: string; method?: string }> {
     const response = await fetch(`${API_BASE_URL}/api/tryon/generate`, {
       method: 'POST',
-      headers: { 'Content-Type': 'application/json' },
+      // Accepting WebP gets the result image back at a fraction of the JPEG size
+      headers: { 'Content-Type': 'application/json', 'Accept': 'application/json, image/webp' },
       body: JSON.stringify({
         userPhoto: params.userPhoto,
         productImage: params.productImage,
@@ -235,29 +236,26 @@ function Card({ variant = 'default', children, className = '' }: { variant?: 'de
   return <motion.div initial={{ opacity: 0, y: 10 }} animate={{ opacity: 1, y: 0 }} className={`rounded-2xl p-5 ${variants[variant]} ${className}`}>{children}</motion.div>
 }
 
-// Compress and resize image for faster upload
-async function compressImage(dataUrl: string, maxSize = 800, quality = 0.85): Promise<string> {
-  return new Promise((resolve) => {
-    const img = new Image()
-    img.onload = () => {
-      const canvas = document.createElement('canvas')
-      let { width, height } = img
-      
-      // Scale down if larger than maxSize
-      if (width > maxSize || height > maxSize) {
-        const ratio = Math.min(maxSize / width, maxSize / height)
-        width *= ratio
-        height *= ratio
-      }
-      
-      canvas.width = width
-      canvas.height = height
-      const ctx = canvas.getContext('2d')!
-      ctx.drawImage(img, 0, 0, width, height)
-      resolve(canvas.toDataURL('image/jpeg', quality))
-    }
-    img.src = dataUrl
-  })
+// Compress and resize image for faster upload. Files are decoded straight
+// into a bitmap rather than through a full-size data URL.
+async function compressImage(file: Blob, maxSize = 800, quality = 0.85): Promise<string> {
+  const img = await createImageBitmap(file)
+  const canvas = document.createElement('canvas')
+  let { width, height } = img
+  
+  // Scale down if larger than maxSize
+  if (width > maxSize || height > maxSize) {
+    const ratio = Math.min(maxSize / width, maxSize / height)
+    width = Math.round(width * ratio)
+    height = Math.round(height * ratio)
+  }
+  
+  canvas.width = width
+  canvas.height = height
+  const ctx = canvas.getContext('2d')!
+  ctx.drawImage(img, 0, 0, width, height)
+  img.close()
+  return canvas.toDataURL('image/jpeg', quality)
 }
 
 // Photo Uploader
@@ -269,16 +267,12 @@ function PhotoUploader({ currentPhoto, onPhotoSelect }: { currentPhoto?: string
   const handleFile = async (file: File) => {
     if (!file.type.startsWith('image/')) return
     setIsProcessing(true)
-    const reader = new FileReader()
-    reader.onload = async (e) => { 
-      const result = e.target?.result as string
-      // Compress image to reduce storage and upload size
-      const compressed = await compressImage(result, 1024, 0.9)
-      setPreview(compressed)
-      onPhotoSelect(compressed)
-      setIsProcessing(false)
-    }
-    reader.readAsDataURL(file)
+    // Downscale to the try-on models' input size (1024px long edge) before
+    // storing, so uploads carry ~100 KB instead of the full-resolution photo
+    const compressed = await compressImage(file, 1024, 0.85)
+    setPreview(compressed)
+    onPhotoSelect(compressed)
+    setIsProcessing(false)
   }
 
   return (